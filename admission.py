@@ -0,0 +1,87 @@
+import time
+import asyncio
+from functools import partial
+from fastapi import HTTPException
+import metrics
+from config import USER_MAX_STREAMS, USER_EGRESS_RATE, USER_EGRESS_BURST, RETRY_AFTER_SECONDS
+
+
+class TokenBucket:
+    """Refills at rate bytes per second up to burst; sends past the balance wait off the debt."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def consume(self, amount):
+        self.refill()
+        self.tokens -= amount
+        if self.tokens < 0:
+            # A user's concurrent streams queue behind each other's debt
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+class AdmissionControl:
+    """
+    Per-user limits on streaming responses: at most USER_MAX_STREAMS at once,
+    with the bytes they send together shaped to USER_EGRESS_RATE. Requests over
+    the cap are shed with 429 and a Retry-After rather than queued.
+    """
+
+    def __init__(self):
+        self.streams = {}  # user_id -> streaming responses in progress
+        self.buckets = {}  # user_id -> TokenBucket, kept while it holds debt
+
+    def admit(self, user_id):
+        """Counts a new stream for the user and returns the callable that ends it, or raises 429."""
+        if len(self.buckets) > len(self.streams) + 1024:
+            self.prune()
+        active = self.streams.get(user_id, 0)
+        if USER_MAX_STREAMS and active >= USER_MAX_STREAMS:
+            metrics.SHED_REQUESTS.inc(reason="user_streams")
+            raise HTTPException(
+                status_code=429,
+                detail="Too many streams at once. Please close one and try again.",
+                headers={"Retry-After": str(RETRY_AFTER_SECONDS)},
+            )
+        self.streams[user_id] = active + 1
+        return partial(self.release, user_id)
+
+    def release(self, user_id):
+        active = self.streams.pop(user_id, 1) - 1
+        if active:
+            self.streams[user_id] = active
+            return
+        bucket = self.buckets.get(user_id)
+        if bucket:
+            bucket.refill()
+            # Reconnecting must not wipe out what is still owed
+            if bucket.tokens >= bucket.burst:
+                del self.buckets[user_id]
+
+    def prune(self):
+        """Drops the buckets of users who left and have since paid off their debt."""
+        for user_id, bucket in list(self.buckets.items()):
+            if user_id not in self.streams:
+                bucket.refill()
+                if bucket.tokens >= bucket.burst:
+                    del self.buckets[user_id]
+
+    async def throttle(self, user_id, amount):
+        """Waits until the user may send amount more bytes."""
+        if not USER_EGRESS_RATE:
+            return
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            bucket = self.buckets[user_id] = TokenBucket(USER_EGRESS_RATE, USER_EGRESS_BURST)
+        await bucket.consume(amount)
+
+
+admission = AdmissionControl()
@@ -1,19 +1,25 @@
 import re
 import asyncio
-import base64
+import logging
 import time
+import heapq
+import math
+from contextvars import ContextVar
 from pyrogram import Client, enums
-from config import API_ID, API_HASH, BOT_TOKEN, WORKER_BOT_TOKENS, CACHE_SIZE, CACHE_DIR
+from pyrogram.errors import FloodWait
+from config import API_ID, API_HASH, BOT_TOKEN, WORKER_BOT_TOKENS, CACHE_SIZE, CACHE_DIR, CHUNK_SIZE, HOT_CACHE_SIZE, MESSAGE_CACHE_SIZE, MESSAGE_CACHE_TTL, WORKER_WAIT_TIMEOUT, SLOT_IDLE_TIMEOUT, HEAP_REBUILD_FACTOR, STREAM_ROLE, BACKGROUND_WEIGHT, RETRY_AFTER_SECONDS
 from itertools import cycle
-from utility import Cache
+from utility import Cache, TTLCache
 
-cache = Cache(CACHE_DIR, CACHE_SIZE)
+# Edge processes only read the shared cache; the coordinator is its single writer
+cache = Cache(CACHE_DIR, CACHE_SIZE, CHUNK_SIZE, HOT_CACHE_SIZE, readonly=STREAM_ROLE == "edge")
 
 class Bot(Client):
     def __init__(self, *args, **kwargs):
         self.worker_id = kwargs.pop("worker_id", None)
         super().__init__(*args, **kwargs)
         self.copy_lock = asyncio.Lock()
+        self.message_cache = TTLCache(MESSAGE_CACHE_SIZE, MESSAGE_CACHE_TTL)
 
     @property
     def telegram_id(self):
@@ -36,9 +42,19 @@ class Bot(Client):
     def remove_surrogates(self, text):
         return ''.join(c for c in text if not (0xD800 <= ord(c) <= 0xDFFF))
 
-    def encode_file_link(self, channel_id, message_id, user_id=0):
-        raw = f"{channel_id}_{message_id}_{user_id}".encode()
-        return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+    async def get_message_cached(self, chat_id, message_id):
+        """Returns a message resolved by this client, hitting Telegram only on a cache miss."""
+        key = (chat_id, message_id)
+        message = self.message_cache.get(key)
+        if message is None:
+            message = await self.get_messages(chat_id=chat_id, message_ids=message_id)
+            if message and not message.empty:
+                self.message_cache.set(key, message)
+        return message
+
+    def forget_message(self, chat_id, message_id):
+        """Drops a cached message, e.g. after its file reference expired."""
+        self.message_cache.pop((chat_id, message_id))
 
 # Initialize main bot
 bot = Bot(
@@ -58,34 +74,236 @@ worker_bots = [
 # Initialize the worker manager
 worker_manager = None
 
+logger = logging.getLogger(__name__)
+
+STATS_ALPHA = 0.2  # weight of the newest sample in worker moving averages
+
+# The viewer a worker slot is being acquired for; None for background work like warming
+current_user = ContextVar("current_user", default=None)
+
+class WorkerSlot:
+    """
+    One unit of a worker's transmission capacity. Release it exactly once,
+    or use it as an async context manager that yields the worker.
+    """
+
+    def __init__(self, manager, worker):
+        self.manager = manager
+        self.worker = worker
+        self.acquired_at = self.last_used = time.monotonic()
+        self.released = False
+
+    def touch(self):
+        self.last_used = time.monotonic()
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.manager._release_slot(self)
+
+    async def __aenter__(self):
+        return self.worker
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+
 class WorkerManager:
+    """
+    Hands out slots on the worker with the lowest estimated cost: its in-flight
+    transmissions weighted by observed chunk latency and error rate, kept in a heap.
+    A worker takes at most max_concurrent_transmissions slots at once, and
+    FloodWaits bench it for exactly the time Telegram asked for.
+
+    When every slot is taken, requests wait in a weighted fair queue keyed on
+    current_user: each user's requests are spaced 1/weight apart in virtual
+    time, so one user with many connections can't crowd out everyone else's.
+    """
+
     def __init__(self, workers):
         self.workers = workers
         self.worker_tasks = {worker.worker_id: 0 for worker in workers}
-        self.cooldowns = {}
-        self.COOLDOWN_PERIOD = 60  # in seconds
+        self.capacity = {worker.worker_id: worker.max_concurrent_transmissions for worker in workers}
+        self.cooldowns = {}  # worker_id -> time.monotonic() deadline
+        self.COOLDOWN_PERIOD = 60  # in seconds, for errors that carry no wait time
+        self.stats = {
+            worker.worker_id: {
+                "latency": 0.5, "throughput": 0.0, "error_rate": 0.0, "flood_wait": 0,
+                "bytes": 0, "bytes_per_second": 0.0, "window_start": time.monotonic(), "window_bytes": 0,
+            }
+            for worker in workers
+        }
+        self.by_id = {worker.worker_id: worker for worker in workers}
+        self.slots = set()
+        self.last_reap = time.monotonic()
+        # Heap entries are (score, version, worker_id); stale versions are skipped lazily
+        self.heap = []
+        self.versions = {worker.worker_id: 0 for worker in workers}
+        self.cooling = []  # (deadline, worker_id)
+        # Fair queue entries are (virtual finish tag, sequence, future); abandoned ones are skipped lazily
+        self.waiters = []
+        self.waiting = 0
+        self.sequence = 0
+        self.virtual_time = 0.0
+        self.user_tags = {}  # user -> finish tag of their last queued request
+        for worker in workers:
+            self._push(worker.worker_id)
+
+    def _score(self, worker_id):
+        stats = self.stats[worker_id]
+        return (self.worker_tasks[worker_id] + 1) * stats["latency"] / max(0.1, 1 - stats["error_rate"])
+
+    def _push(self, worker_id):
+        self.versions[worker_id] += 1
+        if worker_id not in self.cooldowns and self.worker_tasks[worker_id] < self.capacity[worker_id]:
+            heapq.heappush(self.heap, (self._score(worker_id), self.versions[worker_id], worker_id))
+        if len(self.heap) > HEAP_REBUILD_FACTOR * len(self.workers):
+            # Every stat update pushes an entry; drop the stale ones before they pile up
+            self.heap = [entry for entry in self.heap if entry[1] == self.versions[entry[2]]]
+            heapq.heapify(self.heap)
+
+    def _end_cooldowns(self):
+        now = time.monotonic()
+        while self.cooling and self.cooling[0][0] <= now:
+            deadline, worker_id = heapq.heappop(self.cooling)
+            if self.cooldowns.get(worker_id) == deadline:
+                del self.cooldowns[worker_id]
+                self._push(worker_id)
+
+    def _reap_leaks(self):
+        """Reclaims slots nobody has used for SLOT_IDLE_TIMEOUT, e.g. a missed release."""
+        now = time.monotonic()
+        if now - self.last_reap < SLOT_IDLE_TIMEOUT / 4:
+            return
+        self.last_reap = now
+        for slot in [slot for slot in self.slots if now - slot.last_used > SLOT_IDLE_TIMEOUT]:
+            logger.warning(
+                f"Reclaiming leaked slot on worker {slot.worker.worker_id}, "
+                f"held {now - slot.acquired_at:.0f}s and idle {now - slot.last_used:.0f}s."
+            )
+            slot.release()
+
+    def get_slot(self):
+        """Returns a slot on the best available worker right away, or None."""
+        self._end_cooldowns()
+        self._reap_leaks()
+        while self.heap:
+            _, version, worker_id = self.heap[0]
+            if version != self.versions[worker_id]:
+                heapq.heappop(self.heap)
+                continue
+            self.worker_tasks[worker_id] += 1
+            self._push(worker_id)
+            slot = WorkerSlot(self, self.by_id[worker_id])
+            self.slots.add(slot)
+            return slot
+        return None
 
-    def get_worker(self):
-        now = time.time()
-        available_workers = [
-            w for w in self.workers 
-            if w.worker_id not in self.cooldowns or now - self.cooldowns[w.worker_id] > self.COOLDOWN_PERIOD
-        ]
+    def free_slots(self):
+        """Slots available right now on workers that aren't cooling down, 0 while requests queue."""
+        self._end_cooldowns()
+        if self.waiting:
+            return 0
+        return sum(
+            self.capacity[worker_id] - tasks
+            for worker_id, tasks in self.worker_tasks.items()
+            if worker_id not in self.cooldowns
+        )
 
-        if not available_workers:
+    def retry_after(self):
+        """Seconds a client turned away for lack of capacity should wait before retrying."""
+        if self.cooldowns and len(self.cooldowns) == len(self.workers):
+            return max(1, math.ceil(min(self.cooldowns.values()) - time.monotonic()))
+        return RETRY_AFTER_SECONDS
+
+    def _tag(self, user):
+        weight = BACKGROUND_WEIGHT if user is None else 1
+        tag = max(self.virtual_time, self.user_tags.get(user, 0.0)) + 1 / weight
+        self.user_tags[user] = tag
+        if len(self.user_tags) > 4 * len(self.workers) + 1024:
+            # Users whose last tag has passed are back at the front anyway
+            self.user_tags = {u: t for u, t in self.user_tags.items() if t > self.virtual_time}
+        return tag
+
+    async def acquire(self, timeout=WORKER_WAIT_TIMEOUT):
+        """Like get_slot, but waits up to timeout seconds for capacity to free up, in fair order."""
+        slot = self.get_slot()
+        if slot or timeout <= 0:
+            return slot
+        waiter = asyncio.get_running_loop().create_future()
+        self.sequence += 1
+        heapq.heappush(self.waiters, (self._tag(current_user.get()), self.sequence, waiter))
+        self.waiting += 1
+        try:
+            return await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
             return None
+        finally:
+            self.waiting -= 1
+            if not self.waiting:
+                self.waiters.clear()
 
-        # Find the worker with the minimum number of tasks
-        worker = min(available_workers, key=lambda w: self.worker_tasks[w.worker_id])
-        self.worker_tasks[worker.worker_id] += 1
-        return worker
+    def _wake(self):
+        while self.waiters:
+            slot = self.get_slot()
+            if not slot:
+                return
+            tag, _, waiter = heapq.heappop(self.waiters)
+            if waiter.done():
+                slot.released = True
+                self._free(slot)
+                continue
+            self.virtual_time = tag
+            waiter.set_result(slot)
 
-    def release_worker(self, worker_id):
+    def _free(self, slot):
+        self.slots.discard(slot)
+        worker_id = slot.worker.worker_id
         if self.worker_tasks[worker_id] > 0:
             self.worker_tasks[worker_id] -= 1
+            self._push(worker_id)
+
+    def _release_slot(self, slot):
+        self._free(slot)
+        self._wake()
+
+    def put_worker_on_cooldown(self, worker_id, error=None):
+        """Benches a worker; a FloodWait error sets the exact duration."""
+        seconds = self.COOLDOWN_PERIOD
+        if isinstance(error, FloodWait):
+            seconds = error.value
+            self.stats[worker_id]["flood_wait"] = error.value
+        self.record_error(worker_id)
+        deadline = time.monotonic() + seconds
+        self.cooldowns[worker_id] = deadline
+        heapq.heappush(self.cooling, (deadline, worker_id))
+        self._push(worker_id)
+        try:
+            asyncio.get_running_loop().call_later(seconds, self._wake)
+        except RuntimeError:
+            pass
+
+    def record_success(self, worker_id, seconds, size):
+        """Feeds a completed download into the worker's moving averages and byte counters."""
+        stats = self.stats[worker_id]
+        stats["latency"] += STATS_ALPHA * (seconds - stats["latency"])
+        if seconds > 0:
+            stats["throughput"] += STATS_ALPHA * (size / seconds - stats["throughput"])
+        stats["error_rate"] *= 1 - STATS_ALPHA
+        stats["bytes"] += size
+        stats["window_bytes"] += size
+        now = time.monotonic()
+        elapsed = now - stats["window_start"]
+        if elapsed >= 1:
+            stats["bytes_per_second"] = stats["window_bytes"] / elapsed
+            stats["window_start"] = now
+            stats["window_bytes"] = 0
+        self._push(worker_id)
 
-    def put_worker_on_cooldown(self, worker_id):
-        self.cooldowns[worker_id] = time.time()
+    def record_error(self, worker_id):
+        stats = self.stats[worker_id]
+        stats["error_rate"] += STATS_ALPHA * (1 - stats["error_rate"])
+        self._push(worker_id)
 
 def get_worker_manager():
     global worker_manager
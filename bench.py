@@ -0,0 +1,365 @@
+"""
+Offline streaming benchmark. Swaps the worker bots for in-process fakes that
+serve synthetic files with configurable latency, bandwidth and FloodWaits,
+then drives fast_api.api directly over ASGI with concurrent range requests.
+
+    python bench.py --workload all --workers 3 --latency 150 --bandwidth 8
+
+Streaming settings read from the environment (READ_AHEAD_CHUNKS,
+STRIPE_WORKERS, MAX_BATCH_CHUNKS, HOT_CACHE_SIZE, ...) apply as in production,
+so a change can be measured by running the same command before and after it.
+"""
+import os
+import json
+import time
+import random
+import shutil
+import asyncio
+import logging
+import argparse
+import tempfile
+from types import SimpleNamespace
+
+# Placeholders so config imports without a config.env; nothing connects to Telegram or MongoDB
+for name, value in {
+    "API_ID": "1", "API_HASH": "bench", "BOT_TOKEN": "1:bench", "OWNER_ID": "1",
+    "LOG_CHANNEL_ID": "-1", "MONGO_URI": "mongodb://localhost:1",
+}.items():
+    os.environ.setdefault(name, value)
+
+import config
+
+WORKLOADS = ("sequential", "seek", "crowd", "abuse")
+CHANNEL_ID = -1000000000001
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark media_streamer() against fake Telegram workers.")
+    parser.add_argument("--workload", choices=WORKLOADS + ("all",), default="all")
+    parser.add_argument("--workers", type=int, default=3, help="fake worker bots")
+    parser.add_argument("--transmissions", type=int, default=4, help="max_concurrent_transmissions per worker")
+    parser.add_argument("--latency", type=float, default=150, help="ms before a download's first chunk")
+    parser.add_argument("--jitter", type=float, default=0.25, help="random share added to or taken off the latency")
+    parser.add_argument("--bandwidth", type=float, default=8, help="MiB/s each worker downloads at, shared by its transmissions")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="share of downloads answered with a FloodWait")
+    parser.add_argument("--flood-wait", type=int, default=5, help="seconds a FloodWait asks for")
+    parser.add_argument("--file-size", type=float, default=64, help="MiB per synthetic file")
+    parser.add_argument("--viewers", type=int, default=8, help="concurrent clients per workload")
+    parser.add_argument("--seeks", type=int, default=10, help="range requests per client in the seek workload")
+    parser.add_argument("--seek-size", type=float, default=2, help="MiB read after each seek")
+    parser.add_argument("--stagger", type=float, default=2, help="seconds over which crowd viewers join")
+    parser.add_argument("--abuse-connections", type=int, default=16, help="parallel connections of the abusive user")
+    parser.add_argument("--cache-size", type=float, default=4096, help="MiB of disk cache")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print results as JSON lines")
+    return parser.parse_args()
+
+
+args = parse_args()
+random.seed(args.seed)
+cache_dir = tempfile.mkdtemp(prefix="streambot-bench-")
+config.CACHE_DIR = cache_dir
+config.CACHE_SIZE = int(args.cache_size * 1024 * 1024)
+
+import app
+import fast_api
+from app import Bot, cache, get_worker_manager
+from utility import encode_file_link
+from pyrogram.errors import FloodWait
+
+# Worker cooldowns and retries are what is being measured, not logged
+logging.getLogger().setLevel(logging.ERROR)
+
+
+class FakeBot(Bot):
+    """
+    A worker bot whose files live in memory. Every download waits out the
+    configured latency, then its chunks go through one link per bot at the
+    configured bandwidth, however many transmissions share it.
+    """
+
+    def __init__(self, worker_id, files, block):
+        super().__init__(
+            f"bench_{worker_id}", api_id=1, api_hash="bench", in_memory=True, no_updates=True,
+            max_concurrent_transmissions=args.transmissions, worker_id=worker_id,
+        )
+        self.files = files
+        self.block = block
+        self.link_free_at = 0.0
+        self.downloads = 0
+        self.chunks_sent = 0
+        self.flood_waits = 0
+
+    async def round_trip(self):
+        await asyncio.sleep(args.latency / 1000 * (1 + random.uniform(-args.jitter, args.jitter)))
+
+    async def get_messages(self, chat_id, message_ids):
+        await self.round_trip()
+        file_size = self.files[message_ids]
+        document = SimpleNamespace(file_name=f"{message_ids}.mkv", file_size=file_size, mime_type="video/x-matroska")
+        return SimpleNamespace(chat=SimpleNamespace(id=chat_id), id=message_ids, empty=False,
+                               document=document, video=None, audio=None)
+
+    async def stream_media(self, message, limit=0, offset=0):
+        self.downloads += 1
+        if random.random() < args.flood_rate:
+            self.flood_waits += 1
+            raise FloodWait(value=args.flood_wait)
+        await self.round_trip()
+        file_size = self.files[message.id]
+        chunk_count = -(-file_size // config.CHUNK_SIZE)
+        for index in range(offset, min(chunk_count, offset + limit) if limit else chunk_count):
+            length = min(config.CHUNK_SIZE, file_size - index * config.CHUNK_SIZE)
+            now = time.monotonic()
+            self.link_free_at = max(now, self.link_free_at) + length / (args.bandwidth * 1024 * 1024)
+            await asyncio.sleep(self.link_free_at - now)
+            self.chunks_sent += 1
+            yield self.block[:length]
+
+
+async def asgi_get(path, headers):
+    """
+    Sends one GET through the app; returns its status, Content-Length, Retry-After, body bytes,
+    seconds to the first body byte and the exception the app raised, if any.
+    """
+    done = asyncio.Event()
+    result = {"status": None, "bytes": 0, "ttfb": None, "length": None, "retry_after": None, "exception": None}
+    started = time.perf_counter()
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+        "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": b"", "root_path": "",
+        "headers": [(name.lower().encode(), value.encode()) for name, value in headers.items()],
+        "client": ("127.0.0.1", 0), "server": ("bench", 80), "extensions": {},
+    }
+    request_sent = False
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await done.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            headers = dict(message["headers"])
+            result["status"] = message["status"]
+            result["length"] = int(headers.get(b"content-length", -1))
+            if b"retry-after" in headers:
+                result["retry_after"] = int(headers[b"retry-after"])
+        elif message["type"] == "http.response.body" and message.get("body"):
+            if result["ttfb"] is None:
+                result["ttfb"] = time.perf_counter() - started
+            result["bytes"] += len(message["body"])
+
+    try:
+        await fast_api.api(scope, receive, send)
+    except Exception as e:
+        # A server would log it and drop the connection; the run goes on and counts an error
+        result["exception"] = f"{type(e).__name__}: {e}"
+    finally:
+        done.set()
+    return result
+
+
+def percentile(values, share):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+class Run:
+    """
+    Collects one workload's requests and samples worker utilization while it runs.
+    Unmeasured requests, like an abusive user's, only count towards shed load.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.results = []
+        self.unmeasured = []
+        self.utilization = []
+
+    async def get(self, file_link, start=0, end=None, measured=True):
+        byte_range = f"bytes={start}-" if end is None else f"bytes={start}-{end}"
+        result = await asgi_get(f"/stream/{file_link}", {"Range": byte_range})
+        (self.results if measured else self.unmeasured).append(result)
+        return result
+
+    async def sample_workers(self):
+        worker_manager = get_worker_manager()
+        capacity = sum(worker_manager.capacity.values())
+        while True:
+            self.utilization.append(sum(worker_manager.worker_tasks.values()) / capacity)
+            await asyncio.sleep(0.02)
+
+    async def measure(self, clients):
+        cache_before, workers_before = dict(cache.stats), worker_counters()
+        sampler = asyncio.create_task(self.sample_workers())
+        started = time.perf_counter()
+        await asyncio.gather(*clients)
+        seconds = time.perf_counter() - started
+        sampler.cancel()
+
+        stats = {key: cache.stats[key] - cache_before[key] for key in cache.stats}
+        lookups = stats["memory_hits"] + stats["memory_misses"]
+        downloads, chunks, flood_waits = (now - then for now, then in zip(worker_counters(), workers_before))
+        served = sum(result["bytes"] for result in self.results)
+        ttfbs = [result["ttfb"] for result in self.results if result["ttfb"] is not None]
+        return {
+            "workload": self.name,
+            "requests": len(self.results),
+            "errors": sum(1 for r in self.results
+                          if r["exception"] or r["status"] not in (200, 206) or r["bytes"] != r["length"]),
+            "mib": served / 1024 / 1024,
+            "seconds": seconds,
+            "mib_per_second": served / 1024 / 1024 / seconds,
+            "ttfb_p50_ms": percentile(ttfbs, 0.5) * 1000,
+            "ttfb_p90_ms": percentile(ttfbs, 0.9) * 1000,
+            "ttfb_p99_ms": percentile(ttfbs, 0.99) * 1000,
+            "worker_utilization": sum(self.utilization) / max(1, len(self.utilization)),
+            "cache_hit_rate": (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0,
+            "downloads": downloads,
+            "chunks_downloaded": chunks,
+            "flood_waits": flood_waits,
+            "shed": sum(1 for r in self.results + self.unmeasured if r["status"] == 429),
+        }
+
+
+def worker_counters():
+    workers = app.worker_bots
+    return (
+        sum(worker.downloads for worker in workers),
+        sum(worker.chunks_sent for worker in workers),
+        sum(worker.flood_waits for worker in workers),
+    )
+
+
+class Catalog:
+    """Synthetic files, each a message id in the fake channel with a files_col-like document."""
+
+    def __init__(self):
+        self.sizes = {}
+        self.docs = {}
+
+    def add(self, file_size):
+        """Adds a file and returns its _id."""
+        message_id = len(self.sizes) + 1
+        self.sizes[message_id] = file_size
+        _id = f"{message_id:024x}"
+        self.docs[_id] = {
+            "_id": _id, "channel_id": CHANNEL_ID, "message_id": message_id,
+            "file_name": f"{message_id}.mkv", "file_size": file_size, "mime_type": "video/x-matroska",
+        }
+        return _id
+
+    def link(self, _id, user_id):
+        return encode_file_link(_id, user_id, "bench")
+
+    async def get_file_doc(self, _id):
+        return self.docs.get(_id)
+
+
+async def sequential(catalog, file_size):
+    """Every viewer plays a different file from start to end."""
+    return await sequential_viewers(Run("sequential"), catalog, file_size)
+
+
+async def seek(catalog, file_size):
+    """Every viewer jumps around its own file, reading a little after each seek."""
+    run = Run("seek")
+    length = int(args.seek_size * 1024 * 1024)
+
+    async def viewer(link):
+        for _ in range(args.seeks):
+            start = random.randrange(0, max(1, file_size - length))
+            await run.get(link, start, min(file_size, start + length) - 1)
+
+    return await run.measure([
+        viewer(catalog.link(catalog.add(file_size), user_id)) for user_id in range(1, args.viewers + 1)
+    ])
+
+
+async def crowd(catalog, file_size):
+    """All viewers play the same file, joining a little apart."""
+    run = Run("crowd")
+    _id = catalog.add(file_size)
+
+    async def viewer(user_id, delay):
+        await asyncio.sleep(delay)
+        await run.get(catalog.link(_id, user_id))
+
+    return await run.measure([
+        viewer(user_id, random.uniform(0, args.stagger)) for user_id in range(1, args.viewers + 1)
+    ])
+
+
+async def abuse(catalog, file_size):
+    """
+    Viewers play their own files while one user downloads another with many
+    parallel range connections, retrying when shed. Only the viewers are measured.
+    """
+    run = Run("abuse")
+    link = catalog.link(catalog.add(file_size), 0)
+    part = -(-file_size // args.abuse_connections)
+
+    async def connection(start):
+        while True:
+            result = await run.get(link, start, min(file_size, start + part) - 1, measured=False)
+            if result["status"] != 429:
+                return
+            await asyncio.sleep(result["retry_after"] or 1)
+
+    async def downloader():
+        while True:
+            await asyncio.gather(*[connection(start) for start in range(0, file_size, part)])
+
+    abuser = asyncio.create_task(downloader())
+    # Let the download manager grab everything it can first
+    await asyncio.sleep(0.5)
+    try:
+        return await sequential_viewers(run, catalog, file_size)
+    finally:
+        abuser.cancel()
+
+
+async def sequential_viewers(run, catalog, file_size):
+    links = [catalog.link(catalog.add(file_size), user_id) for user_id in range(1, args.viewers + 1)]
+    return await run.measure([run.get(link) for link in links])
+
+
+def report(result):
+    if args.json:
+        print(json.dumps(result))
+        return
+    print(
+        f"{result['workload']:<11} {result['requests']:>5} req {result['errors']:>3} err "
+        f"{result['mib']:>8.1f} MiB {result['seconds']:>7.2f} s {result['mib_per_second']:>7.1f} MiB/s | "
+        f"TTFB p50 {result['ttfb_p50_ms']:>6.0f} p90 {result['ttfb_p90_ms']:>6.0f} p99 {result['ttfb_p99_ms']:>6.0f} ms | "
+        f"workers {result['worker_utilization']:>4.0%} busy | cache hits {result['cache_hit_rate']:>4.0%} | "
+        f"{result['downloads']} downloads, {result['chunks_downloaded']} chunks, {result['flood_waits']} FloodWaits, "
+        f"{result['shed']} shed"
+    )
+
+
+async def main():
+    catalog = Catalog()
+    fast_api.get_file_doc = catalog.get_file_doc
+    fast_api.is_user_authorized = lambda user_id, otp: asyncio.sleep(0, True)
+    block = random.randbytes(config.CHUNK_SIZE)
+    app.worker_bots[:] = [FakeBot(i, catalog.sizes, block) for i in range(args.workers)]
+    app.worker_manager = None
+
+    file_size = int(args.file_size * 1024 * 1024)
+    workloads = WORKLOADS if args.workload == "all" else (args.workload,)
+    for workload in workloads:
+        report(await globals()[workload](catalog, file_size))
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
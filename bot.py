@@ -1,13 +1,19 @@
 
+import os
+import sys
 import asyncio
 import uvicorn
 import logging
 import handlers
+import metrics
 
 from app import bot, worker_bots
-from db import files_col
-from fast_api import api
-from config import LOG_CHANNEL_ID
+from db import files_col, auth_users_col
+from fast_api import api, get_file_meta, store_chunk, fetch_chunks
+from config import LOG_CHANNEL_ID, STREAM_PROCESSES, COORDINATOR_SOCKET
+from coordinator import CoordinatorServer
+from utility import subtitle_indexer
+from warmer import warmer
 
 async def main():
     """
@@ -16,6 +22,15 @@ async def main():
     index_info = await files_col.index_information()
     if "file_name_text" not in index_info:
         await files_col.create_index([("file_name", "text")])
+    if "file_name_1" not in index_info:
+        await files_col.create_index([("file_name", 1)])
+    if "channel_id_1_message_id_1" not in index_info:
+        await files_col.create_index([("channel_id", 1), ("message_id", 1)])
+    if "pinned_1" not in index_info:
+        await files_col.create_index([("pinned", 1)], sparse=True)
+    auth_index_info = await auth_users_col.index_information()
+    if "user_id_1_otp_1_expiry_-1" not in auth_index_info:
+        await auth_users_col.create_index([("user_id", 1), ("otp", 1), ("expiry", -1)])
     try:
         await bot.start()
         logging.info("Main bot started.")
@@ -29,20 +44,61 @@ async def main():
 
     # get the running event loop and schedule FastAPI server
     loop = asyncio.get_running_loop()
-    loop.create_task(start_fastapi())
+    if STREAM_PROCESSES > 1:
+        loop.create_task(start_coordinator())
+        loop.create_task(start_stream_processes())
+    else:
+        loop.create_task(start_fastapi())
+    loop.create_task(subtitle_indexer())
+    loop.create_task(warmer.run(get_file_meta, fetch_chunks))
 
 async def start_fastapi():
     """
     Starts the FastAPI server using Uvicorn.
     """
     try:
-        config = uvicorn.Config(api, host="0.0.0.0", port=8000, loop="asyncio", log_level="warning")
+        # No log_config: uvicorn's loggers then propagate to the root queue handler
+        # and its sampler instead of writing to stderr on their own
+        config = uvicorn.Config(api, host="0.0.0.0", port=8000, loop="asyncio", log_level="warning", log_config=None)
         server = uvicorn.Server(config)
         await server.serve()
     except KeyboardInterrupt:
         pass
         logging.info("FastAPI server stopped.")
 
+async def start_coordinator():
+    """
+    Serves metadata and chunk fills to the edge processes from this process's workers.
+    """
+    metrics.process_labels = (("process", "coordinator"),)
+    server = CoordinatorServer(COORDINATOR_SOCKET, {
+        "meta": get_file_meta,
+        "chunk": store_chunk,
+        "accesses": warmer.merge_accesses,
+        "metrics": get_metrics_snapshot,
+    })
+    await server.serve()
+
+async def get_metrics_snapshot():
+    return metrics.snapshot()
+
+async def start_stream_processes():
+    """
+    Runs the FastAPI app in STREAM_PROCESSES uvicorn processes sharing the port.
+    """
+    env = dict(os.environ, STREAM_ROLE="edge")
+    # Through uvicorn.run rather than its CLI, which cannot turn off uvicorn's own
+    # log config; without it, uvicorn logs go through each process's queue handler
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "-c",
+        "import uvicorn; uvicorn.run('fast_api:api', host='0.0.0.0', port=8000, "
+        f"workers={STREAM_PROCESSES}, log_level='warning', log_config=None)",
+        env=env,
+    )
+    logging.info(f"Started {STREAM_PROCESSES} streaming processes.")
+    await process.wait()
+    logging.error(f"Streaming processes exited with code {process.returncode}.")
+
 if __name__ == "__main__":
     try:
         bot.loop.run_until_complete(main())
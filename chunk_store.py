@@ -0,0 +1,439 @@
+import os
+import mmap
+import json
+import asyncio
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+MAX_OPEN_SEGMENTS = 256
+
+
+class Segment:
+    """
+    One cached Telegram file: a sparse data file holding chunk i at offset
+    i * chunk_size, a bitmap of the chunks present and the file's metadata record.
+    """
+
+    def __init__(self, directory, file_key, chunk_size):
+        self.file_key = file_key
+        self.chunk_size = chunk_size
+        self.data_path = os.path.join(directory, f"{file_key}.seg")
+        self.map_path = os.path.join(directory, f"{file_key}.map")
+        self.meta_path = os.path.join(directory, f"{file_key}.json")
+        self.bitmap = bytearray()
+        self.length = 0   # apparent size of the sparse data file
+        self.size = 0     # bytes of chunk data actually held
+        self.meta = None
+        self.pins = set()  # chunks kept when the segment is evicted
+        self.trimming = False
+        self.pending_writes = 0
+        self.fd = None
+        self.map_fd = None
+        self.mmap = None
+
+    def load(self):
+        """Rebuilds the in-memory index from disk, after a restart or another process wrote."""
+        self.bitmap = bytearray()
+        self.length = 0
+        self.meta = None
+        if os.path.exists(self.map_path):
+            with open(self.map_path, "rb") as f:
+                self.bitmap = bytearray(f.read())
+        if os.path.exists(self.data_path):
+            self.length = os.path.getsize(self.data_path)
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                self.meta = json.load(f)
+        self.pins = set(self.meta.get("pinned", ())) if self.meta else set()
+        self.size = sum(self.chunk_length(i) for i in self.chunks())
+
+    def chunks(self):
+        for byte_index, byte in enumerate(self.bitmap):
+            if byte:
+                for bit in range(8):
+                    if byte & (1 << bit):
+                        yield byte_index * 8 + bit
+
+    def has(self, index):
+        byte_index = index >> 3
+        return byte_index < len(self.bitmap) and bool(self.bitmap[byte_index] & (1 << (index & 7)))
+
+    def chunk_length(self, index):
+        # Only the last chunk of a file is short, and it always ends the data file
+        return max(0, min(self.chunk_size, self.length - index * self.chunk_size))
+
+    @property
+    def is_open(self):
+        return self.fd is not None
+
+    def open(self, readonly=False):
+        if readonly:
+            self.fd = os.open(self.data_path, os.O_RDONLY)
+            self.map_fd = os.open(self.map_path, os.O_RDONLY)
+            return
+        self.fd = os.open(self.data_path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.map_fd = os.open(self.map_path, os.O_RDWR | os.O_CREAT, 0o644)
+
+    def is_stale(self):
+        """True if the files were replaced since they were opened, e.g. evicted and refilled."""
+        try:
+            return os.stat(self.data_path).st_ino != os.fstat(self.fd).st_ino
+        except FileNotFoundError:
+            return True
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            os.close(self.map_fd)
+        self.fd = None
+        self.map_fd = None
+        # Not closed explicitly: memoryviews handed out may still reference it
+        self.mmap = None
+
+    def read(self, index):
+        """Returns a zero-copy view of a present chunk."""
+        offset = index * self.chunk_size
+        if self.mmap is None or len(self.mmap) < self.length:
+            self.mmap = mmap.mmap(self.fd, self.length, access=mmap.ACCESS_READ)
+        return memoryview(self.mmap)[offset:offset + self.chunk_length(index)]
+
+    def write(self, index, data):
+        """Writes chunk data in place. Safe to run off the event loop."""
+        os.pwrite(self.fd, data, index * self.chunk_size)
+
+    def mark(self, index, length):
+        """Records a written chunk in the bitmap, after its data hit the file."""
+        byte_index = index >> 3
+        if byte_index >= len(self.bitmap):
+            self.bitmap.extend(bytes(byte_index + 1 - len(self.bitmap)))
+        self.bitmap[byte_index] |= 1 << (index & 7)
+        os.pwrite(self.map_fd, bytes((self.bitmap[byte_index],)), byte_index)
+        self.length = max(self.length, index * self.chunk_size + length)
+        self.size += length
+
+    def write_meta(self, meta):
+        self.meta = meta
+        self.pins = set(meta.get("pinned", ()))
+        # Replaced whole, so readers in other processes never see it half written
+        with open(self.meta_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(self.meta_path + ".tmp", self.meta_path)
+
+    @property
+    def pinned_size(self):
+        return sum(self.chunk_length(i) for i in self.pins if self.has(i))
+
+    def rewrite(self, kept):
+        """
+        Replaces the segment's files with copies holding only the kept chunks and
+        returns their bitmap. Runs off the event loop; nothing else writes the
+        segment meanwhile, and readers keep the old files until they reopen.
+        """
+        bitmap = bytearray(len(self.bitmap))
+        for index in kept:
+            bitmap[index >> 3] |= 1 << (index & 7)
+        with open(self.data_path, "rb") as source, open(self.data_path + ".tmp", "wb") as target:
+            for index in kept:
+                offset, length = index * self.chunk_size, self.chunk_length(index)
+                # Copied inside the kernel
+                while length:
+                    copied = os.copy_file_range(source.fileno(), target.fileno(), length, offset, offset)
+                    if not copied:
+                        break
+                    offset += copied
+                    length -= copied
+            # Same apparent size, so the short last chunk keeps its length
+            target.truncate(self.length)
+        with open(self.map_path + ".tmp", "wb") as f:
+            f.write(bitmap)
+        # Bitmap first: a reader catching the new bitmap with the old data only misses chunks
+        os.replace(self.map_path + ".tmp", self.map_path)
+        os.replace(self.data_path + ".tmp", self.data_path)
+        return bitmap
+
+    def remove(self):
+        self.close()
+        for path in (self.data_path, self.map_path, self.meta_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class ChunkStore:
+    """
+    Chunk cache built on per-file segment files. Hits are served from mmap
+    without copying; whole files are evicted least-recently-used to stay
+    under size_limit, except for pinned chunks, which survive eviction.
+    Pins are capped at pin_limit bytes; past it the least recently used
+    files lose theirs.
+
+    A readonly store shares the directory with the one process that writes
+    it, and rereads a segment's bitmap from disk when a chunk looks missing.
+    """
+
+    def __init__(self, directory, size_limit, chunk_size, readonly=False, pin_limit=0):
+        self.directory = directory
+        self.size_limit = size_limit
+        self.pin_limit = pin_limit
+        self.chunk_size = chunk_size
+        self.readonly = readonly
+        self.segments = OrderedDict()
+        self.open_segments = OrderedDict()
+        self.size = 0
+        # Files with pinned chunks, least recently used first, and the bytes their pins cover
+        self.pinned = OrderedDict()
+        self.pinned_bytes = 0
+        self.trims = set()
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    def load(self):
+        keys = {}
+        for entry in os.scandir(self.directory):
+            name, ext = os.path.splitext(entry.name)
+            if ext == ".tmp":
+                # Left behind by an interrupted trim or metadata write; a readonly
+                # store leaves them to the writer, which may be mid-write right now
+                if not self.readonly:
+                    os.remove(entry.path)
+            elif ext in (".seg", ".json"):
+                keys[name] = max(keys.get(name, 0), entry.stat().st_mtime)
+        # Oldest first, so the LRU order survives restarts approximately
+        for file_key in sorted(keys, key=keys.get):
+            segment = Segment(self.directory, file_key, self.chunk_size)
+            try:
+                segment.load()
+            except (OSError, ValueError) as e:
+                if not self.readonly:
+                    logger.warning(f"Dropping unreadable cache segment {file_key}: {e}")
+                    segment.remove()
+                continue
+            self.segments[file_key] = segment
+            self.size += segment.size
+            if segment.pins and not self.readonly:
+                self._track_pins(segment)
+        self._enforce_pin_limit()
+        self.evict()
+
+    def segment(self, file_key, create=False):
+        segment = self.segments.get(file_key)
+        if segment is None:
+            if not create:
+                return None
+            segment = Segment(self.directory, file_key, self.chunk_size)
+            self.segments[file_key] = segment
+        self.segments.move_to_end(file_key)
+        if file_key in self.pinned:
+            self.pinned.move_to_end(file_key)
+        return segment
+
+    def _open(self, segment):
+        if not segment.is_open:
+            if self.readonly:
+                # The writer may have refilled the segment since we last looked
+                segment.load()
+            segment.open(self.readonly)
+        self.open_segments[segment.file_key] = segment
+        self.open_segments.move_to_end(segment.file_key)
+        for file_key in list(self.open_segments):
+            if len(self.open_segments) <= MAX_OPEN_SEGMENTS:
+                break
+            oldest = self.open_segments[file_key]
+            if oldest.pending_writes:
+                continue
+            del self.open_segments[file_key]
+            oldest.close()
+
+    def _refresh(self, file_key):
+        """Picks up what the writing process stored for a file since we last looked."""
+        segment = self.segments.get(file_key)
+        if segment is None:
+            segment = Segment(self.directory, file_key, self.chunk_size)
+        elif segment.is_open and segment.is_stale():
+            self.open_segments.pop(file_key, None)
+            segment.close()
+        try:
+            segment.load()
+        except (OSError, ValueError):
+            return None
+        if not segment.bitmap and segment.meta is None:
+            self.segments.pop(file_key, None)
+            return None
+        self.segments[file_key] = segment
+        return segment
+
+    def _lookup(self, file_key, index):
+        segment = self.segment(file_key)
+        if self.readonly and (segment is None or not segment.has(index)):
+            segment = self._refresh(file_key)
+        if segment is None or not segment.has(index):
+            return None
+        return segment
+
+    def has(self, file_key, index):
+        segment = self.segments.get(file_key)
+        return segment is not None and segment.has(index)
+
+    def get(self, file_key, index):
+        segment = self._lookup(file_key, index)
+        if segment is None:
+            return None
+        try:
+            self._open(segment)
+        except FileNotFoundError:
+            # Evicted by the writing process
+            return None
+        return segment.read(index)
+
+    async def put(self, file_key, index, data):
+        if self.readonly:
+            return
+        segment = self.segment(file_key, create=True)
+        if segment.has(index) or segment.trimming:
+            return
+        self._open(segment)
+        segment.pending_writes += 1
+        try:
+            await asyncio.to_thread(segment.write, index, data)
+        finally:
+            segment.pending_writes -= 1
+        if self.segments.get(file_key) is not segment or segment.has(index):
+            return
+        segment.mark(index, len(data))
+        self.size += len(data)
+        self.evict(keep=file_key)
+
+    def get_meta(self, file_key):
+        segment = self.segments.get(file_key)
+        if self.readonly and (segment is None or segment.meta is None):
+            segment = self._refresh(file_key)
+        return segment.meta if segment else None
+
+    def put_meta(self, file_key, meta):
+        if self.readonly:
+            return
+        segment = self.segment(file_key, create=True)
+        if segment.pins:
+            # Pins are the store's own record, not part of what callers write
+            meta = {**meta, "pinned": sorted(segment.pins)}
+        segment.write_meta(meta)
+
+    def pin(self, file_key, indices):
+        """
+        Exempts chunks of a file from eviction; they are recorded in its metadata.
+        Unpins the least recently used files when pins would exceed pin_limit.
+        """
+        if self.readonly:
+            return
+        segment = self.segment(file_key)
+        if segment is None or segment.meta is None:
+            return
+        self._untrack_pins(file_key)
+        indices = sorted(indices)
+        if len(indices) * self.chunk_size > self.pin_limit:
+            indices = []
+        segment.write_meta({**segment.meta, "pinned": indices})
+        if indices:
+            self._track_pins(segment)
+            self._enforce_pin_limit(keep=file_key)
+
+    def pins(self, file_key):
+        segment = self.segments.get(file_key)
+        return set(segment.pins) if segment is not None else set()
+
+    def unpin(self, file_key):
+        segment = self.segments.get(file_key)
+        self._untrack_pins(file_key)
+        if segment is not None and segment.pins:
+            segment.write_meta({key: value for key, value in segment.meta.items() if key != "pinned"})
+
+    def _track_pins(self, segment):
+        self.pinned[segment.file_key] = len(segment.pins) * self.chunk_size
+        self.pinned_bytes += self.pinned[segment.file_key]
+
+    def _untrack_pins(self, file_key):
+        self.pinned_bytes -= self.pinned.pop(file_key, 0)
+
+    def _enforce_pin_limit(self, keep=None):
+        for file_key in list(self.pinned):
+            if self.pinned_bytes <= self.pin_limit:
+                break
+            if file_key != keep:
+                self.unpin(file_key)
+
+    def evict(self, keep=None):
+        if self.readonly:
+            return
+        while self.size > self.size_limit:
+            # Segments with writes in flight keep their descriptors until done;
+            # those down to their pinned chunks have nothing left to give
+            file_key = next((
+                k for k, s in self.segments.items()
+                if k != keep and not s.pending_writes and not s.trimming and s.size > s.pinned_size
+            ), None)
+            if file_key is None:
+                break
+            if self.segments[file_key].pins:
+                self.trim(file_key)
+            else:
+                self.remove(file_key)
+
+    def trim(self, file_key):
+        """Shrinks a segment to its pinned chunks. The bytes count as freed right away."""
+        segment = self.segments[file_key]
+        kept = [i for i in segment.pins if segment.has(i)]
+        freed = segment.size - segment.pinned_size
+        segment.size -= freed
+        self.size -= freed
+        segment.trimming = True
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # At startup, before anything is being served
+            self._finish_trim(segment, kept)
+            return
+        task = loop.create_task(self._trim(segment, kept))
+        self.trims.add(task)
+        task.add_done_callback(self.trims.discard)
+
+    async def _trim(self, segment, kept):
+        # Copying up to PIN_MAX_CHUNKS chunks must not stall the loop
+        try:
+            bitmap = await asyncio.to_thread(segment.rewrite, kept)
+        except OSError as e:
+            self._trim_failed(segment, e)
+            return
+        self._apply_trim(segment, bitmap)
+
+    def _finish_trim(self, segment, kept):
+        try:
+            bitmap = segment.rewrite(kept)
+        except OSError as e:
+            self._trim_failed(segment, e)
+            return
+        self._apply_trim(segment, bitmap)
+
+    def _apply_trim(self, segment, bitmap):
+        segment.trimming = False
+        if self.open_segments.get(segment.file_key) is segment:
+            del self.open_segments[segment.file_key]
+        segment.close()
+        segment.bitmap = bitmap
+
+    def _trim_failed(self, segment, error):
+        logger.warning(f"Could not trim cache segment {segment.file_key}, dropping it: {error}")
+        segment.trimming = False
+        if self.segments.get(segment.file_key) is segment:
+            self.remove(segment.file_key)
+
+    def remove(self, file_key):
+        segment = self.segments.pop(file_key, None)
+        if segment is None:
+            return
+        self._untrack_pins(file_key)
+        self.open_segments.pop(file_key, None)
+        self.size -= segment.size
+        segment.remove()
@@ -1,20 +1,70 @@
 
 import os
+import time
+import queue
+import atexit
 import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, WatchedFileHandler
 from dotenv import load_dotenv
 from os import environ
 from requests import get as rget
 
 # Logger setup
 LOG_FILE = "bot_log.txt"
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
-    handlers=[
-        logging.FileHandler(LOG_FILE, encoding="utf-8"),
-        logging.StreamHandler()
-    ]
-)
+LOG_MAX_BYTES = 10 * 1024 * 1024  # rotate the log file past 10 MB
+LOG_BACKUP_COUNT = 3
+LOG_SAMPLE_WINDOW = 10  # seconds
+LOG_SAMPLE_BURST = 20  # records per call site and window before the rest are dropped
+
+
+class LogSampler(logging.Filter):
+    """
+    Lets through at most LOG_SAMPLE_BURST warnings and below per call site in each
+    LOG_SAMPLE_WINDOW, so a FloodWait storm logs a sample instead of every chunk.
+    The next record let through reports how many were dropped.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.windows = {}  # (pathname, lineno) -> [window start, count, dropped]
+
+    def filter(self, record):
+        if record.levelno > logging.WARNING:
+            return True
+        now = time.monotonic()
+        window = self.windows.setdefault((record.pathname, record.lineno), [now, 0, 0])
+        if now - window[0] >= LOG_SAMPLE_WINDOW:
+            if window[2]:
+                record.msg = f"{record.msg} ({window[2]} similar messages suppressed)"
+            self.windows[(record.pathname, record.lineno)] = [now, 1, 0]
+            return True
+        window[1] += 1
+        if window[1] > LOG_SAMPLE_BURST:
+            window[2] += 1
+            return False
+        return True
+
+
+# Records are only queued on the event loop; a listener thread does the file and console I/O
+formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+if os.getenv("STREAM_ROLE") == "edge":
+    # Edge processes share the bot process's log file and follow its rotations
+    file_handler = WatchedFileHandler(LOG_FILE, encoding="utf-8")
+else:
+    file_handler = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8")
+stream_handler = logging.StreamHandler()
+file_handler.setFormatter(formatter)
+stream_handler.setFormatter(formatter)
+
+log_queue = queue.SimpleQueue()
+queue_handler = QueueHandler(log_queue)
+# Only merges the message with its arguments and traceback; the listener's handlers format the line
+queue_handler.setFormatter(logging.Formatter("%(message)s"))
+queue_handler.addFilter(LogSampler())
+logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
+log_listener = QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
 
 logger = logging.getLogger("sharing_bot")
                 
@@ -55,5 +105,65 @@ SECRET_KEY = os.getenv('SECRET_KEY', '7Jz5hR6v8K9m2n4pQ3wE1rT4yU5iO6pA7sS8dD9fG0
 
 # Caching configuration
 CACHE_SIZE = 16 * 1024 * 1024 * 1024  # 16 GB
+HOT_CACHE_SIZE = int(os.getenv('HOT_CACHE_SIZE', 256 * 1024 * 1024))  # in-memory tier in front of the disk cache, 0 disables
+HOT_HEAD_CHUNKS = 2  # leading chunks of each file admitted to memory on first use (headers, moov)
+HOT_TAIL_CHUNKS = 1  # trailing chunks admitted likewise (tail moov, cues)
+HOT_SEEN_ENTRIES = 65536  # chunks remembered for second-hit admission
+PIN_HEAD_SECONDS = 10  # seconds of media from the start kept cached alongside each file's seek index
+PIN_MAX_CHUNKS = 64  # most chunks pinned per file
+PIN_CACHE_SHARE = 0.2  # share of CACHE_SIZE pins may cover; least recently used files are unpinned past it
 CHUNK_SIZE = 1024 * 1024  # 1 MB
+READ_AHEAD_CHUNKS = int(os.getenv('READ_AHEAD_CHUNKS', 4))  # chunks prefetched past the playhead, 0 disables
+WORKER_WAIT_TIMEOUT = int(os.getenv('WORKER_WAIT_TIMEOUT', 10))  # seconds a request queues for a worker before 429
+SLOT_IDLE_TIMEOUT = 300  # seconds a worker slot may sit unused before it is reclaimed as leaked
+HEAP_REBUILD_FACTOR = 4  # worker heap entries per worker, stale ones included, before it is rebuilt
+STRIPE_WORKERS = int(os.getenv('STRIPE_WORKERS', 2))  # chunk fetches of one stream in flight at once, spread over workers
+MAX_BATCH_CHUNKS = int(os.getenv('MAX_BATCH_CHUNKS', 8))  # most chunks one Telegram download covers on sequential reads
 CACHE_DIR = "cache"
+# Sent with file responses; contents never change, but links stop working when access expires
+STREAM_CACHE_CONTROL = os.getenv('STREAM_CACHE_CONTROL', 'public, max-age=3600')
+
+# Resolved Telegram messages, cached per worker since file references are client-specific
+MESSAGE_CACHE_SIZE = int(os.getenv('MESSAGE_CACHE_SIZE', 10000))
+MESSAGE_CACHE_TTL = int(os.getenv('MESSAGE_CACHE_TTL', 1800))  # in seconds
+
+# Per-user admission control, keyed on the user_id in file links. Edge processes
+# each apply the stream cap and egress rate on their own
+USER_MAX_STREAMS = int(os.getenv('USER_MAX_STREAMS', 4))  # concurrent streaming responses per user, 0 disables
+USER_EGRESS_RATE = int(os.getenv('USER_EGRESS_RATE', 8 * 1024 * 1024))  # bytes per second across a user's streams, 0 disables
+USER_EGRESS_BURST = 64 * 1024 * 1024  # bytes sent at full speed before shaping starts, e.g. initial buffering
+BACKGROUND_WEIGHT = 0.25  # worker slot share of warming and indexing next to one viewer's, when slots are contended
+RETRY_AFTER_SECONDS = 2  # Retry-After sent with 429s when no better estimate exists
+
+# Keyframe segments of files played over /hls, so playlists aren't reparsed per viewer
+HLS_INDEX_CACHE_SIZE = 256
+HLS_INDEX_CACHE_TTL = 3600  # in seconds
+
+# Authorization decisions, capped by each record's own expiry
+AUTH_CACHE_SIZE = 50000
+AUTH_CACHE_TTL = int(os.getenv('AUTH_CACHE_TTL', 300))  # in seconds
+AUTH_NEGATIVE_CACHE_TTL = 5  # in seconds
+
+# File records from files_col, keyed by _id
+FILE_CACHE_SIZE = 100000
+FILE_CACHE_TTL = int(os.getenv('FILE_CACHE_TTL', 600))  # in seconds
+SUBTITLE_INDEX_INTERVAL = 300  # seconds between passes pairing new subtitles with videos
+
+# In-process search index over file names
+SEARCH_INDEX_INTERVAL = 60  # seconds between passes adding new files
+SEARCH_REBUILD_INTERVAL = 6 * 60 * 60  # seconds between full rebuilds, which drop deleted files
+SEARCH_RESULTS_PER_PAGE = 10
+SEARCH_MAX_PER_PAGE = 50
+
+# Multi-process streaming: with STREAM_PROCESSES > 1 the bot process owns the Telegram
+# clients and serves chunks over COORDINATOR_SOCKET to that many uvicorn "edge" processes
+STREAM_PROCESSES = int(os.getenv('STREAM_PROCESSES', 1))
+STREAM_ROLE = os.getenv('STREAM_ROLE', 'standalone')  # set to "edge" for the uvicorn processes
+COORDINATOR_SOCKET = os.getenv('COORDINATOR_SOCKET', 'coordinator.sock')
+
+# Background cache warming with idle worker capacity
+WARM_INTERVAL = int(os.getenv('WARM_INTERVAL', 60))  # seconds between passes queueing new, trending and pinned files
+WARM_HEAD_CHUNKS = 4  # leading chunks warmed for new and trending files
+WARM_TAIL_CHUNKS = 2  # trailing chunks warmed likewise, where a tail moov lives
+WARM_TRENDING_FILES = 20  # most-played files queued per pass
+WARM_RESERVED_SLOTS = int(os.getenv('WARM_RESERVED_SLOTS', 2))  # free worker slots left to live streams
@@ -0,0 +1,354 @@
+import math
+import struct
+import logging
+from array import array
+from functools import partial
+from app import cache, current_user
+from config import CHUNK_SIZE, HOT_HEAD_CHUNKS, MAX_BATCH_CHUNKS, PIN_HEAD_SECONDS, PIN_MAX_CHUNKS
+
+logger = logging.getLogger(__name__)
+
+EBML_MAGIC = b"\x1a\x45\xdf\xa3"
+MP4_TOP_LEVEL = {b"ftyp", b"styp", b"moov", b"mdat", b"free", b"skip", b"wide", b"pdin", b"uuid", b"moof", b"sidx"}
+
+# Matroska element IDs, with their length markers
+SEGMENT = 0x18538067
+SEEK_HEAD = 0x114D9B74
+SEEK = 0x4DBB
+SEEK_ID = 0x53AB
+SEEK_POSITION = 0x53AC
+INFO = 0x1549A966
+TIMECODE_SCALE = 0x2AD7B1
+DURATION = 0x4489
+CUES = 0x1C53BB6B
+CLUSTER = 0x1F43B675
+
+# What a malformed or truncated container raises while being parsed
+PARSE_ERRORS = (ValueError, IndexError, KeyError, struct.error)
+
+
+def read_vint(data, pos, keep_marker=False):
+    """Decodes an EBML variable-length integer; returns (value, next position, all ones)."""
+    first = data[pos]
+    length, mask = 1, 0x80
+    while length <= 8 and not first & mask:
+        mask >>= 1
+        length += 1
+    if length > 8 or pos + length > len(data):
+        raise ValueError("Invalid EBML integer")
+    value = first if keep_marker else first & (mask - 1)
+    for byte in data[pos + 1:pos + length]:
+        value = value << 8 | byte
+    all_ones = not keep_marker and value == (1 << (7 * length)) - 1
+    return value, pos + length, all_ones
+
+
+def read_uint(data):
+    return int.from_bytes(data, "big")
+
+
+async def read_element(read, offset):
+    """Returns (id, data offset, data size or None when unknown) of the EBML element at offset."""
+    header = await read(offset, 12)
+    element_id, pos, _ = read_vint(header, 0, keep_marker=True)
+    size, pos, unknown = read_vint(header, pos)
+    return element_id, offset + pos, None if unknown else size
+
+
+def iter_elements(data):
+    """Yields (id, body) of the elements packed in a fully read master element."""
+    pos = 0
+    while pos < len(data):
+        element_id, pos, _ = read_vint(data, pos, keep_marker=True)
+        size, pos, _ = read_vint(data, pos)
+        yield element_id, data[pos:pos + size]
+        pos += size
+
+
+async def locate_mkv_index(read, file_size):
+    _, pos, size = await read_element(read, 0)
+    element_id, segment_start, segment_size = await read_element(read, pos + size)
+    if element_id != SEGMENT:
+        raise ValueError("No Matroska segment")
+    segment_end = file_size if segment_size is None else min(file_size, segment_start + segment_size)
+
+    cues_offset = None
+    duration = None
+    scale = 1000000
+    offset = segment_start
+    # Walk the segment's top level up to the first cluster; clusters are not skipped,
+    # that would mean reading the whole file to find tail cues without a SeekHead
+    while offset < segment_end:
+        element_id, data_offset, size = await read_element(read, offset)
+        if element_id == CLUSTER:
+            break
+        if size is None:
+            break
+        if element_id == SEEK_HEAD:
+            for seek_id, seek in iter_elements(await read(data_offset, size)):
+                if seek_id != SEEK:
+                    continue
+                fields = dict(iter_elements(seek))
+                if read_uint(fields.get(SEEK_ID, b"")) == CUES and SEEK_POSITION in fields:
+                    cues_offset = segment_start + read_uint(fields[SEEK_POSITION])
+        elif element_id == INFO:
+            fields = dict(iter_elements(await read(data_offset, size)))
+            if TIMECODE_SCALE in fields:
+                scale = read_uint(fields[TIMECODE_SCALE])
+            if DURATION in fields:
+                value = fields[DURATION]
+                duration = struct.unpack(">f" if len(value) == 4 else ">d", value)[0] * scale / 1e9
+        elif element_id == CUES:
+            cues_offset = offset
+        offset = data_offset + size
+
+    index = None
+    if cues_offset is not None and cues_offset < file_size:
+        element_id, data_offset, size = await read_element(read, cues_offset)
+        if element_id == CUES and size is not None:
+            index = [cues_offset, min(file_size, data_offset + size) - 1]
+    return {"format": "mkv", "index": index, "duration": duration}
+
+
+async def read_box(read, offset, file_size):
+    """Returns (type, header size, total size) of the MP4 box at offset."""
+    header = await read(offset, 16)
+    size, box_type = struct.unpack(">I4s", header[:8])
+    header_size = 8
+    if size == 1:
+        size = struct.unpack(">Q", header[8:16])[0]
+        header_size = 16
+    elif size == 0:
+        size = file_size - offset
+    if size < header_size:
+        raise ValueError(f"Corrupt {box_type!r} box")
+    return box_type, header_size, size
+
+
+def iter_boxes(data, offset, end):
+    """Yields (type, body start, body end) of the MP4 boxes packed in data[offset:end]."""
+    while offset + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", data, offset)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", data, offset + 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size:
+            raise ValueError(f"Corrupt {box_type!r} box")
+        yield box_type, offset + header_size, min(end, offset + size)
+        offset += size
+
+
+def child_boxes(data, start, end):
+    """{type: (body start, body end)} of the first box of each type inside a box body."""
+    boxes = {}
+    for box_type, body_start, body_end in iter_boxes(data, start, end):
+        boxes.setdefault(box_type, (body_start, body_end))
+    return boxes
+
+
+def sidx_references(sidx, sidx_end):
+    """(byte offset, seconds) of the subsegments a segment index box points at, and where they end."""
+    version = sidx[0]
+    timescale = struct.unpack_from(">I", sidx, 8)[0]
+    if version == 0:
+        earliest, first_offset = struct.unpack_from(">II", sidx, 12)
+        pos = 20
+    else:
+        earliest, first_offset = struct.unpack_from(">QQ", sidx, 12)
+        pos = 28
+    count = struct.unpack_from(">H", sidx, pos + 2)[0]
+    offset, ticks = sidx_end + first_offset, earliest
+    references = []
+    for reference, duration, _ in struct.iter_unpack(">III", sidx[pos + 4:pos + 4 + 12 * count]):
+        if reference >> 31:
+            # Points at another sidx; nested indexes are not followed
+            return [], offset
+        references.append((offset, ticks / timescale))
+        offset += reference & 0x7FFFFFFF
+        ticks += duration
+    return references, offset
+
+
+async def locate_mp4_index(read, file_size, keyframes=False):
+    boxes = {}
+    offset = 0
+    # Top-level boxes are few; mdat is skipped by its size however large
+    while offset + 8 <= file_size and not (b"moov" in boxes and (b"mdat" in boxes or b"moof" in boxes)):
+        box_type, header_size, size = await read_box(read, offset, file_size)
+        boxes.setdefault(box_type, (offset, offset + header_size, min(file_size, offset + size)))
+        offset += size
+    container = {"format": "mp4", "index": None, "duration": None}
+    if b"moov" not in boxes:
+        return container
+
+    moov_start, moov_body, moov_end = boxes[b"moov"]
+    container["index"] = [moov_start, moov_end - 1]
+    moov = await read(moov_start, moov_end - moov_start)
+    children = child_boxes(moov, moov_body - moov_start, len(moov))
+    container["fragmented"] = b"mvex" in children and b"sidx" in boxes
+    if b"mvhd" in children:
+        mvhd = children[b"mvhd"][0]
+        if moov[mvhd] == 1:
+            timescale, length = struct.unpack_from(">IQ", moov, mvhd + 20)
+        else:
+            timescale, length = struct.unpack_from(">II", moov, mvhd + 12)
+        if timescale:
+            container["duration"] = length / timescale
+    if not keyframes or not container["fragmented"]:
+        return container
+
+    # Each subsegment of the index starts with a fragment
+    sidx_start, sidx_body, sidx_end = boxes[b"sidx"]
+    references, media_end = sidx_references(await read(sidx_body, sidx_end - sidx_body), sidx_end)
+    container["keyframes"] = references
+    if references:
+        container["init"] = [0, moov_end - 1]
+        container["media"] = [references[0][0], media_end]
+    return container
+
+
+async def locate_index(read, file_size, keyframes=False):
+    """
+    Finds where a file's seek index lives: the MP4 moov box or the Matroska Cues.
+    Returns {"format", "index": [first byte, last byte] or None, "duration": seconds or None},
+    plus for MP4 whether it is "fragmented" with a segment index (sidx).
+    With keyframes, a fragmented MP4 also gets the (byte offset, seconds) positions of
+    its fragments and, when there are any, its "init" header and "media" [start, end) byte ranges.
+    """
+    head = await read(0, 12)
+    if head[:4] == EBML_MAGIC:
+        return await locate_mkv_index(read, file_size)
+    if head[4:8] in MP4_TOP_LEVEL:
+        return await locate_mp4_index(read, file_size, keyframes)
+    return {"format": None, "index": None, "duration": None}
+
+
+def chunk_aligned_segments(keyframes, media_start, media_end, duration):
+    """
+    Splits the media into segments that start on a keyframe, one per CHUNK_SIZE chunk:
+    the first keyframe in each chunk opens a segment. Returns (byte offsets, start times)
+    of the segment boundaries, the last being the end of the media at its duration.
+    """
+    offsets, times = array("q", [media_start]), array("d", [0.0])
+    first_time = keyframes[0][1]
+    for offset, seconds in keyframes:
+        if media_start < offset < media_end and offset // CHUNK_SIZE > offsets[-1] // CHUNK_SIZE:
+            offsets.append(offset)
+            times.append(seconds - first_time)
+    if not duration and offsets[-1] > media_start:
+        # Extrapolated at the average bitrate of the indexed part
+        duration = times[-1] * (media_end - media_start) / (offsets[-1] - media_start)
+    offsets.append(media_end)
+    times.append(max(duration or 0.0, times[-1]))
+    return offsets, times
+
+
+def chunks_to_pin(container, file_size):
+    """The chunks holding the seek index and about PIN_HEAD_SECONDS of the start of the media."""
+    chunk_count = -(-file_size // CHUNK_SIZE)
+    head_chunks = HOT_HEAD_CHUNKS
+    if container["duration"]:
+        head_bytes = PIN_HEAD_SECONDS * file_size / container["duration"]
+        head_chunks = max(1, math.ceil(head_bytes / CHUNK_SIZE))
+    chunks = []
+    if container["index"]:
+        first, last = container["index"]
+        chunks.extend(range(first // CHUNK_SIZE, last // CHUNK_SIZE + 1))
+    chunks.extend(range(min(head_chunks, chunk_count)))
+    # The index goes first: without it every seek costs round trips
+    return sorted(set(chunks[:PIN_MAX_CHUNKS]))
+
+
+def chunk_reader(file_key, file_size, fetch_run):
+    """Returns read(offset, length) over a file's chunks, through the cache."""
+
+    async def read(offset, length):
+        length = min(length, file_size - offset)
+        if length <= 0:
+            return b""
+        first, last = offset // CHUNK_SIZE, (offset + length - 1) // CHUNK_SIZE
+        data = b"".join([
+            bytes(await cache.get_or_fetch_run(file_key, index, last - index + 1, fetch_run) or b"")
+            for index in range(first, last + 1)
+        ])
+        start = offset - first * CHUNK_SIZE
+        return data[start:start + length]
+
+    return read
+
+
+async def pin_container_index(channel_id, message_id, file_meta, fetch_chunks):
+    """
+    Parses a file's container once, records it in the metadata record and pins
+    the chunks players read before the first frame and on every seek.
+    """
+    # The task copies the context of whichever viewer opened the file first;
+    # its downloads are background work, not that viewer's
+    current_user.set(None)
+    file_key = f"{channel_id}_{message_id}"
+    file_size = file_meta["file_size"]
+    fetch_run = partial(fetch_chunks, channel_id, message_id)
+    read = chunk_reader(file_key, file_size, fetch_run)
+
+    try:
+        container = await locate_index(read, file_size)
+    except PARSE_ERRORS as e:
+        logger.warning(f"Could not parse the container of {file_key}: {e}")
+        container = {"format": None, "index": None, "duration": None}
+    file_meta["container"] = container
+    await cache.put_meta(file_key, file_meta)
+
+    chunks = chunks_to_pin(container, file_size)
+    # Chunks pinned already stay so, e.g. all of an owner-pinned file
+    cache.store.pin(file_key, set(chunks) | cache.store.pins(file_key))
+    for position, index in enumerate(chunks):
+        if (file_key, index) in cache:
+            continue
+        run_length = 1
+        while (run_length < MAX_BATCH_CHUNKS and position + run_length < len(chunks)
+               and chunks[position + run_length] == index + run_length):
+            run_length += 1
+        await cache.get_or_fetch_run(file_key, index, run_length, fetch_run)
+
+
+async def locate_segments(channel_id, message_id, file_size, fetch_chunks):
+    """
+    Returns {"init": [first byte, last byte], "offsets", "times"} describing a file as
+    byte-range segments (see chunk_aligned_segments), or None unless it is a fragmented
+    MP4 with a usable segment index: HLS players only take fMP4 (or MPEG-TS) segments.
+    """
+    file_key = f"{channel_id}_{message_id}"
+    read = chunk_reader(file_key, file_size, partial(fetch_chunks, channel_id, message_id))
+    try:
+        container = await locate_index(read, file_size, keyframes=True)
+    except PARSE_ERRORS as e:
+        logger.warning(f"Could not index the keyframes of {file_key}: {e}")
+        return None
+    if "init" not in container:
+        return None
+    offsets, times = chunk_aligned_segments(container["keyframes"], *container["media"], container["duration"])
+    return {"init": container["init"], "offsets": offsets, "times": times}
+
+
+def hls_playlist(segments, uri):
+    """Renders an HLS VOD media playlist of EXT-X-BYTERANGE segments of the file at uri."""
+    offsets, times = segments["offsets"], segments["times"]
+    durations = [times[i + 1] - times[i] for i in range(len(times) - 1)]
+    first, last = segments["init"]
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:6",
+        f"#EXT-X-TARGETDURATION:{max(1, math.ceil(max(durations, default=1)))}",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+        "#EXT-X-PLAYLIST-TYPE:VOD",
+        f'#EXT-X-MAP:URI="{uri}",BYTERANGE="{last - first + 1}@{first}"',
+    ]
+    for i, duration in enumerate(durations):
+        lines.append(f"#EXTINF:{duration:.3f},")
+        lines.append(f"#EXT-X-BYTERANGE:{offsets[i + 1] - offsets[i]}@{offsets[i]}")
+        lines.append(uri)
+    lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n"
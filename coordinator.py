@@ -0,0 +1,115 @@
+import os
+import json
+import asyncio
+import logging
+from fastapi import HTTPException
+from config import COORDINATOR_SOCKET
+
+logger = logging.getLogger(__name__)
+
+# Large enough for any request line; replies are small JSON objects
+STREAM_LIMIT = 1024 * 1024
+
+
+class CoordinatorServer:
+    """
+    Runs in the process that owns the pyrogram clients and serves edge
+    processes over a Unix socket. Each line is a JSON request
+    {"id", "op", "params"} answered by {"id", "result"} or {"id", "error"}.
+    """
+
+    def __init__(self, path, handlers):
+        self.path = path
+        self.handlers = handlers
+
+    async def serve(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        server = await asyncio.start_unix_server(self._handle, self.path, limit=STREAM_LIMIT)
+        logger.info(f"Coordinator listening on {self.path}")
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        tasks = set()
+        try:
+            while line := await reader.readline():
+                task = asyncio.create_task(self._dispatch(json.loads(line), writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (ConnectionError, ValueError) as e:
+            logger.warning(f"Coordinator connection dropped: {e}")
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def _dispatch(self, request, writer):
+        reply = {"id": request.get("id")}
+        try:
+            handler = self.handlers[request["op"]]
+            reply["result"] = await handler(**request.get("params", {}))
+        except HTTPException as e:
+            reply["error"] = [e.status_code, e.detail, e.headers]
+        except Exception as e:
+            logger.error(f"Coordinator {request.get('op')} failed: {e}", exc_info=True)
+            reply["error"] = [500, "Coordinator error", None]
+        if not writer.is_closing():
+            writer.write(json.dumps(reply, default=str).encode() + b"\n")
+
+
+class CoordinatorClient:
+    """Multiplexes calls from an edge process over one connection to the coordinator."""
+
+    def __init__(self, path):
+        self.path = path
+        self.writer = None
+        self.pending = {}
+        self.next_id = 0
+        self.connect_lock = asyncio.Lock()
+
+    async def _connect(self):
+        async with self.connect_lock:
+            if self.writer and not self.writer.is_closing():
+                return
+            reader, self.writer = await asyncio.open_unix_connection(self.path, limit=STREAM_LIMIT)
+            asyncio.create_task(self._read_replies(reader, self.writer))
+
+    async def _read_replies(self, reader, writer):
+        try:
+            while line := await reader.readline():
+                reply = json.loads(line)
+                waiter = self.pending.pop(reply.get("id"), None)
+                if waiter and not waiter.done():
+                    waiter.set_result(reply)
+        except (ConnectionError, ValueError) as e:
+            logger.warning(f"Lost connection to coordinator: {e}")
+        finally:
+            writer.close()
+            if self.writer is writer:
+                self.writer = None
+            for waiter in self.pending.values():
+                if not waiter.done():
+                    waiter.set_exception(ConnectionError("Coordinator connection closed"))
+            self.pending.clear()
+
+    async def call(self, op, **params):
+        try:
+            await self._connect()
+            self.next_id += 1
+            request_id = self.next_id
+            waiter = asyncio.get_running_loop().create_future()
+            self.pending[request_id] = waiter
+            self.writer.write(json.dumps({"id": request_id, "op": op, "params": params}).encode() + b"\n")
+            await self.writer.drain()
+            reply = await waiter
+        except (ConnectionError, OSError) as e:
+            logger.error(f"Coordinator unavailable: {e}")
+            raise HTTPException(status_code=503, detail="Streaming backend unavailable.")
+        if "error" in reply:
+            status_code, detail, headers = reply["error"]
+            raise HTTPException(status_code=status_code, detail=detail, headers=headers)
+        return reply["result"]
+
+
+coordinator = CoordinatorClient(COORDINATOR_SOCKET)
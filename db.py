@@ -1,9 +1,10 @@
 from motor.motor_asyncio import AsyncIOMotorClient
 from config import MONGO_URI
+from metrics import MongoCommandListener
 
 
 # MongoDB setup
-mongo = AsyncIOMotorClient(MONGO_URI)
+mongo = AsyncIOMotorClient(MONGO_URI, event_listeners=[MongoCommandListener()])
 db = mongo["sharing_bot"]
 files_col = db["files"]
 auth_users_col = db["auth_users"]
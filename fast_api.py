@@ -1,19 +1,32 @@
 
+import os
 import base64
+import math
+import time
 import asyncio
 import mimetypes
 import logging
+from functools import partial
+from contextlib import aclosing
+from collections import deque
 from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
 from fastapi import FastAPI, Request, HTTPException, Response
-from fastapi.responses import StreamingResponse, JSONResponse, RedirectResponse, FileResponse
+from fastapi.responses import StreamingResponse, JSONResponse, RedirectResponse, FileResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pyrogram.errors import ChannelInvalid, FloodWait, RPCError, AuthBytesInvalid, FileReferenceExpired
 from pyrogram.errors.exceptions.internal_server_error_500 import Timeout
 from starlette.status import HTTP_404_NOT_FOUND
 from fastapi.staticfiles import StaticFiles
-from utility import human_readable_size, decode_file_link, is_user_authorized
-from app import get_worker_manager, cache, Bot
-from config import MY_DOMAIN, CHUNK_SIZE, OWNER_ID
+from utility import human_readable_size, decode_file_link, is_user_authorized, get_file_doc, get_subtitle, encode_file_link, TTLCache
+from app import get_worker_manager, cache, current_user
+from coordinator import coordinator
+from warmer import warmer, report_accesses
+from admission import admission
+from search import search_files, search_indexer
+from container import pin_container_index, locate_segments, hls_playlist
+import metrics
+from config import MY_DOMAIN, CHUNK_SIZE, OWNER_ID, READ_AHEAD_CHUNKS, STRIPE_WORKERS, MAX_BATCH_CHUNKS, STREAM_ROLE, STREAM_CACHE_CONTROL, SEARCH_RESULTS_PER_PAGE, SEARCH_MAX_PER_PAGE, HLS_INDEX_CACHE_SIZE, HLS_INDEX_CACHE_TTL
 from db import files_col, auth_users_col
 from bson.objectid import ObjectId
 from fastapi.encoders import ENCODERS_BY_TYPE
@@ -22,6 +35,11 @@ ENCODERS_BY_TYPE[ObjectId] = str
 
 api = FastAPI()
 api.mount("/static", StaticFiles(directory="static"), name="static")
+metrics.collectors.append(partial(metrics.collect_cache, cache))
+if STREAM_ROLE != "edge":
+    metrics.collectors.append(lambda: metrics.collect_workers(get_worker_manager()))
+else:
+    metrics.process_labels = (("process", f"edge-{os.getpid()}"),)
 api.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -30,17 +48,22 @@ api.add_middleware(
     allow_headers=["*"],
 )
 
+@api.on_event("startup")
+async def start_search_indexer():
+    asyncio.create_task(search_indexer())
+
+if STREAM_ROLE == "edge":
+    @api.on_event("startup")
+    async def start_access_reports():
+        asyncio.create_task(report_accesses())
+
 MAX_RETRIES = 3       
 RETRY_DELAY = 3     
 
 logger = logging.getLogger(__name__)
 
-async def get_file_properties(message):
-    channel_id = message.chat.id
-    message_id = message.id
-
-    # Try to get file doc from DB
-    file_doc = await files_col.find_one({"channel_id": channel_id, "message_id": message_id})
+async def get_file_properties(message, file_doc=None):
+    # The DB name takes precedence; file_doc comes from the cached file record
     file_name = file_doc.get("file_name") if file_doc else None
 
     # Extract file info from Telegram message
@@ -54,148 +77,520 @@ async def get_file_properties(message):
 
     # If DB doesn't have a name, fall back to Telegram-provided file_name
     actual_file_name = file_name or getattr(media, "file_name", "Unknown")
+    mime_type = getattr(media, "mime_type", None) or mimetypes.guess_type(actual_file_name)[0]
+
+    return actual_file_name, media.file_size, mime_type
+
+class RequestMetricsMiddleware:
+    """
+    Records each request's time until its response headers, by route and status.
+    Plain ASGI, so streamed bodies pass straight through without an extra hop.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.monotonic()
+        # Read back as request.state.started, e.g. for time to first byte
+        scope.setdefault("state", {})["started"] = started
+        status = 500
+        headers_sent_at = None
+
+        async def send_with_status(message):
+            nonlocal status, headers_sent_at
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers_sent_at = time.monotonic()
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            metrics.REQUEST_LATENCY.observe(
+                (headers_sent_at or time.monotonic()) - started,
+                method=scope["method"],
+                route=route.path if route else "unmatched",
+                status=status,
+            )
 
-    return actual_file_name, media.file_size
+api.add_middleware(RequestMetricsMiddleware)
 
 @api.get("/")
 async def root():
     return JSONResponse({"message": "👋 Hola Amigo!"})
 
-
-async def get_file_stream(channel_id, message_id, request: Request):
-    worker_manager = get_worker_manager()
+@api.get("/metrics")
+async def get_metrics():
+    others = []
+    if STREAM_ROLE == "edge":
+        try:
+            # The workers live in the coordinator, which serves no HTTP itself
+            others.append(await coordinator.call("metrics"))
+        except HTTPException:
+            pass
+    return PlainTextResponse(metrics.render(others), media_type="text/plain; version=0.0.4")
+
+
+async def acquire_message(worker_manager, channel_id, message_id):
+    """
+    Takes a worker slot and resolves the message with it, retrying on other workers.
+    The returned slot is held and must be released by the caller.
+    """
     message = None
-    worker = None
+    slot = None
 
     for _ in range(MAX_RETRIES):
-        worker = worker_manager.get_worker()
-        if not worker:
-            raise HTTPException(status_code=503, detail="All workers are busy. Please try again later.")
+        slot = await worker_manager.acquire()
+        if not slot:
+            metrics.SHED_REQUESTS.inc(reason="workers_busy")
+            raise HTTPException(
+                status_code=429,
+                detail="All workers are busy. Please try again later.",
+                headers={"Retry-After": str(worker_manager.retry_after())},
+            )
+        worker = slot.worker
 
         try:
-            message = await worker.get_messages(chat_id=channel_id, message_ids=message_id)
+            message = await worker.get_message_cached(channel_id, message_id)
             if message:
                 break 
-        except (FloodWait, Timeout, RPCError, AuthBytesInvalid, FileReferenceExpired):
-            worker_manager.release_worker(worker.worker_id)
-            worker_manager.put_worker_on_cooldown(worker.worker_id)
+        except (FloodWait, Timeout, RPCError, AuthBytesInvalid, FileReferenceExpired) as e:
+            slot.release()
+            worker_manager.put_worker_on_cooldown(worker.worker_id, e)
             continue
         except ChannelInvalid:
-            worker_manager.release_worker(worker.worker_id)
+            slot.release()
             raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail="Channel not found")
+        except Exception as e:
+            slot.release()
+            worker_manager.put_worker_on_cooldown(worker.worker_id, e)
+            raise HTTPException(status_code=500, detail=f"Worker error: {e}")
     else:
         # If loop finishes without success
-        if worker:
-            worker_manager.release_worker(worker.worker_id)
         raise HTTPException(status_code=500, detail="All workers failed to fetch message.")
 
     if not message:
-        worker_manager.release_worker(worker.worker_id)
+        slot.release()
         raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail="File not found")
 
-    file_name, file_size = await get_file_properties(message)
-    range_header = request.headers.get("range")
-    start, end = 0, file_size - 1
+    return slot, message
+
+
+def meta_from_doc(file_doc):
+    """Builds the metadata record from what an earlier resolve stored on the files_col document."""
+    if file_doc.get("file_size") is None or not file_doc.get("file_name"):
+        return None
+    return {
+        "file_name": file_doc["file_name"],
+        "file_size": file_doc["file_size"],
+        "mime_type": file_doc.get("mime_type"),
+        "chunk_count": -(-file_doc["file_size"] // CHUNK_SIZE),
+    }
+
+
+async def get_file_meta(file_doc):
+    """
+    Returns the file's metadata record (name, size, mime type, chunk count).
+    It is resolved from Telegram only the first time and then persisted on the
+    files_col document, so HEAD and /details never need a worker afterwards.
+    The first lookup also starts locating and pinning the container's seek index.
+    """
+    channel_id, message_id = file_doc['channel_id'], file_doc['message_id']
+    file_key = f"{channel_id}_{message_id}"
+    file_meta = await cache.get_meta(file_key)
+    if file_meta is None:
+        if STREAM_ROLE == "edge":
+            # The coordinator records it in the shared cache, from the document when it can
+            return await coordinator.call("meta", file_doc={
+                "channel_id": channel_id,
+                "message_id": message_id,
+                "file_name": file_doc.get("file_name"),
+                "file_size": file_doc.get("file_size"),
+                "mime_type": file_doc.get("mime_type"),
+            })
+        file_meta = meta_from_doc(file_doc) or await resolve_file_meta(file_doc)
+        await cache.put_meta(file_key, file_meta)
+
+    if "container" not in file_meta and STREAM_ROLE != "edge":
+        index_container(channel_id, message_id, file_meta)
+    return file_meta
+
+
+async def resolve_file_meta(file_doc):
+    """Builds the metadata record from the Telegram message and stores it on the document."""
+    channel_id, message_id = file_doc['channel_id'], file_doc['message_id']
+    slot, message = await acquire_message(get_worker_manager(), channel_id, message_id)
+    async with slot:
+        file_name, file_size, mime_type = await get_file_properties(message, file_doc)
+
+    stored = {"file_size": file_size, "mime_type": mime_type}
+    if not file_doc.get("file_name"):
+        stored["file_name"] = file_name
+    await files_col.update_many({"channel_id": channel_id, "message_id": message_id}, {"$set": stored})
+    file_doc.update(stored)
+    return {
+        "file_name": file_name,
+        "file_size": file_size,
+        "mime_type": mime_type,
+        "chunk_count": -(-file_size // CHUNK_SIZE),
+    }
+
+
+# Container parses in progress by file key, so each file is parsed once at a time
+container_tasks = {}
+
+
+def index_container(channel_id, message_id, file_meta):
+    file_key = f"{channel_id}_{message_id}"
+    if file_key in container_tasks:
+        return
+    task = asyncio.create_task(pin_container_index(channel_id, message_id, file_meta, fetch_chunks))
+    container_tasks[file_key] = task
+    task.add_done_callback(partial(finish_container_index, file_key))
 
-    if range_header:
-        range_value = range_header.strip().split("=")[1]
-        start_str, end_str = range_value.split("-")[:2]
-        start = int(start_str)
-        if end_str:
-            end = int(end_str)
+
+def finish_container_index(file_key, task):
+    del container_tasks[file_key]
+    if not task.cancelled() and task.exception():
+        # Retried on the file's next metadata lookup
+        logger.warning(f"Indexing the container of {file_key} failed: {task.exception()}")
+
+
+async def fetch_chunks(channel_id, message_id, chunk_index, count):
+    """
+    Downloads count consecutive chunks from Telegram with one stream_media call,
+    yielding them in order. A failing worker is put on cooldown and the rest
+    of the run continues on another one. A worker slot is held only while
+    the run is being transmitted.
+    """
+    worker_manager = get_worker_manager()
+    end_index = chunk_index + count
+    for attempt in range(1, MAX_RETRIES + 1):
+        slot, message = await acquire_message(worker_manager, channel_id, message_id)
+        worker = slot.worker
+        try:
+            slot.touch()
+            started = time.monotonic()
+            async for chunk_data in worker.stream_media(message, offset=chunk_index, limit=end_index - chunk_index):
+                finished = time.monotonic()
+                worker_manager.record_success(worker.worker_id, finished - started, len(chunk_data))
+                slot.touch()
+                yield chunk_data
+                chunk_index += 1
+                started = time.monotonic()
+            return
+
+        except (FloodWait, Timeout, RPCError, AuthBytesInvalid, FileReferenceExpired) as e:
+            logger.warning(f"Worker {worker.worker_id} failed with {e.__class__.__name__}. Putting on cooldown.")
+            if isinstance(e, FileReferenceExpired):
+                worker.forget_message(channel_id, message_id)
+            worker_manager.put_worker_on_cooldown(worker.worker_id, e)
+            # The next attempt resolves the message again with another worker
+
+        except Exception as e:
+            logger.error(f"Unexpected error with worker {worker.worker_id}: {e}", exc_info=True)
+            worker_manager.put_worker_on_cooldown(worker.worker_id, e)
+            raise HTTPException(status_code=500, detail="Unexpected error during streaming.")
+
+        finally:
+            slot.release()
+
+    raise HTTPException(status_code=503, detail="All workers failed to fetch chunk.")
+
+
+async def store_chunk(channel_id, message_id, chunk_index, count=1, user_id=None):
+    """
+    Coordinator side of fetch_chunk_via_coordinator: makes sure a chunk is in
+    the shared on-disk cache and returns its length (0 if there is none).
+    A count above one downloads the chunks after it in the same run, and
+    user_id is the viewer it is for, who queues for worker slots fairly.
+    """
+    current_user.set(user_id)
+    file_key = f"{channel_id}_{message_id}"
+    # Edges read the chunk from the shared disk, so it has no use in this process's memory tier
+    chunk = await cache.get_or_fetch_run(file_key, chunk_index, count, partial(fetch_chunks, channel_id, message_id), promote=False)
+    if not chunk:
+        return 0
+    if not cache.store.has(file_key, chunk_index):
+        # Served from the memory tier after the disk copy was evicted
+        await cache.store.put(file_key, chunk_index, chunk)
+    return len(chunk)
+
+
+async def fetch_chunk_via_coordinator(channel_id, message_id, chunk_index, count=1):
+    """Edge processes have no Telegram clients: the coordinator fills the shared cache."""
+    if not await coordinator.call(
+            "chunk", channel_id=channel_id, message_id=message_id, chunk_index=chunk_index, count=count,
+            user_id=current_user.get()):
+        return None
+    return cache.store.get(f"{channel_id}_{message_id}", chunk_index)
+
+
+async def fetch_chunks_via_coordinator(channel_id, message_id, chunk_index, count):
+    """Edge counterpart of fetch_chunks, yielding the run's chunks as the coordinator stores them."""
+    for run_index in range(chunk_index, chunk_index + count):
+        chunk = await fetch_chunk_via_coordinator(channel_id, message_id, run_index, chunk_index + count - run_index)
+        if not chunk:
+            return
+        yield chunk
+
+
+def parse_range(range_header, file_size):
+    """
+    Returns the (start, end) byte range a Range header asks for, clamped to the file,
+    or None when the header should be ignored and the whole file sent.
+    Raises 416 when none of the requested bytes exist.
+    """
+    if not range_header:
+        return None
+    unit, _, byte_range = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in byte_range:
+        # Other units and multipart ranges aren't supported, which RFC 9110 allows
+        return None
+    start_str, separator, end_str = byte_range.strip().partition("-")
+    if not separator:
+        return None
+    try:
+        if start_str:
+            start = int(start_str)
+            end = int(end_str) if end_str else file_size - 1
+            if end_str and end < start:
+                return None
+        else:
+            # Suffix range: the last N bytes, e.g. a player reading a tail moov
+            suffix_length = int(end_str)
+            if suffix_length <= 0:
+                raise HTTPException(status_code=416, detail="Requested range not satisfiable",
+                                    headers={"Content-Range": f"bytes */{file_size}"})
+            start, end = max(0, file_size - suffix_length), file_size - 1
+    except ValueError:
+        return None
+    if start >= file_size:
+        raise HTTPException(status_code=416, detail="Requested range not satisfiable",
+                            headers={"Content-Range": f"bytes */{file_size}"})
+    return start, min(end, file_size - 1)
+
+
+def file_validators(file_doc, file_meta):
+    """Strong ETag and Last-Modified of a file; a Telegram message's media never changes."""
+    validators = {"ETag": f'"{file_doc["channel_id"]}-{file_doc["message_id"]}-{file_meta["file_size"]}"'}
+    if isinstance(file_doc["_id"], ObjectId):
+        validators["Last-Modified"] = format_datetime(file_doc["_id"].generation_time, usegmt=True)
+    return validators
+
+
+def is_not_modified(request: Request, validators):
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # Weak comparison, as RFC 9110 requires for If-None-Match
+        etags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return "*" in etags or validators["ETag"] in etags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and "Last-Modified" in validators:
+        try:
+            return parsedate_to_datetime(validators["Last-Modified"]) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def if_range_matches(request: Request, validators):
+    """False when an If-Range validator is stale, meaning the whole file must be sent."""
+    if_range = request.headers.get("if-range")
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith(('"', "W/")):
+        return if_range == validators["ETag"]
+    return if_range == validators.get("Last-Modified")
+
+
+async def send_file(request: Request, file_doc, headers, count_play=False, user_id=None):
+    """
+    Answers GET and HEAD for a file with range, conditional and caching semantics.
+    headers carries the route's own headers, e.g. Content-Type. With a user_id
+    the body is subject to that user's admission control.
+    """
+    file_meta = await get_file_meta(file_doc)
+    file_size = file_meta["file_size"]
+    validators = file_validators(file_doc, file_meta)
+    headers = {**validators, "Cache-Control": STREAM_CACHE_CONTROL, "Accept-Ranges": "bytes", **headers}
+
+    if is_not_modified(request, validators):
+        return Response(status_code=304, headers={**validators, "Cache-Control": STREAM_CACHE_CONTROL})
+
+    byte_range = None
+    if if_range_matches(request, validators):
+        byte_range = parse_range(request.headers.get("range"), file_size)
+    if byte_range:
+        start, end = byte_range
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{file_size}"
+    else:
+        start, end = 0, file_size - 1
+        status_code = 200
+    headers["Content-Length"] = str(end - start + 1)
+
+    if request.method == "HEAD":
+        return Response(status_code=status_code, headers=headers)
+
+    if count_play and start < CHUNK_SIZE:
+        # Roughly one per play, feeding the warmer's trending files
+        warmer.record_access(str(file_doc["_id"]))
+    end_stream = admission.admit(user_id) if user_id is not None else None
+    media_streamer = await get_file_stream(file_doc, request, start, end, user_id)
+    body = media_streamer()
+    try:
+        # The first chunk is fetched before the headers go out, so a worker queue
+        # timeout, a FloodWait or a failed lookup is a real 429/503, not a cut-off body
+        first = await anext(body, None)
+    except BaseException:
+        if end_stream:
+            end_stream()
+        raise
+    return RangeStreamingResponse(
+        prepend(first, body), status_code=status_code, headers=headers, on_close=end_stream)
+
+
+async def prepend(first, body):
+    """Yields first, unless None, then the rest of body, closing body when done."""
+    async with aclosing(body):
+        if first is not None:
+            yield first
+        async for chunk in body:
+            yield chunk
+
+
+async def get_file_stream(file_doc, request: Request, start, end, user_id=None):
+    """
+    Returns a generator function streaming bytes start to end of a file, inclusive,
+    paced by user_id's egress rate when one is given.
+    """
+    channel_id, message_id = file_doc['channel_id'], file_doc['message_id']
+    file_key = f"{channel_id}_{message_id}"
 
     chunk_offset = start // CHUNK_SIZE
+    last_chunk_index = end // CHUNK_SIZE
     byte_offset_in_chunk = start % CHUNK_SIZE
     bytes_to_send = end - start + 1
 
+    # Caps how many of this request's chunk fetches are in flight; the scheduler
+    # spreads them over workers, so consecutive chunks download in parallel
+    stripe = asyncio.Semaphore(STRIPE_WORKERS)
+    # Runs stay short enough that STRIPE_WORKERS of them cover the read-ahead
+    # window, otherwise one run holds it all and the other workers sit idle
+    max_run_length = max(1, min(MAX_BATCH_CHUNKS, math.ceil((READ_AHEAD_CHUNKS + 1) / STRIPE_WORKERS)))
+    closed = False
+
+    async def fetch_run(chunk_index, count):
+        async with stripe:
+            fetch = fetch_chunks_via_coordinator if STREAM_ROLE == "edge" else fetch_chunks
+            async with aclosing(fetch(channel_id, message_id, chunk_index, count)) as chunks:
+                async for chunk in chunks:
+                    if closed:
+                        # The request is gone; waiters sharing this run fetch the rest themselves
+                        return
+                    yield chunk
+
+    async def get_chunk(chunk_index, count):
+        # Concurrent viewers missing on the same chunk share a single download
+        chunk = await cache.get_or_fetch_run(file_key, chunk_index, count, fetch_run)
+        if chunk is None:
+            # A shared run from a request that went away gave up, fetch it ourselves
+            chunk = await cache.get_or_fetch_run(file_key, chunk_index, 1, fetch_run)
+        return chunk
+
     async def media_streamer():
+        """
+        Yields the requested range. Up to READ_AHEAD_CHUNKS chunks past the one
+        being sent are fetched concurrently, striped over workers, and
+        consumed in order. Misses are downloaded in runs that start at one
+        chunk and double while the read stays sequential, up to MAX_BATCH_CHUNKS
+        or a share of the read-ahead window small enough to stripe, so seeks and
+        small ranges fetch little and long reads make few requests. Cache hits
+        are memoryviews of the chunk store's mmap, sent without another copy.
+        """
+        nonlocal closed
+        # Worker slots for this stream's downloads are queued for fairly under its user
+        current_user.set(user_id)
         bytes_sent = 0
-        current_chunk_index = chunk_offset
+        next_to_fetch = chunk_offset
         is_first_chunk = True
+        # Reorder buffer: fetches complete in any order but are awaited in order
+        pending = deque()
+        metrics.ACTIVE_STREAMS.inc()
 
         try:
             while bytes_sent < bytes_to_send:
-                cache_key = f"{channel_id}_{message_id}_{current_chunk_index}"
-                chunk = await cache.get(cache_key)
-
-                if chunk is None:
-                    # Cache miss: Start streaming from the worker
-                    nonlocal worker, message
-                    for attempt in range(1, MAX_RETRIES + 1):
-                        try:
-                            stream = worker.stream_media(message, offset=current_chunk_index)
-                            async for chunk_data in stream:
-                                await cache.put(f"{channel_id}_{message_id}_{current_chunk_index}", chunk_data)
-
-                                # Handle byte offset on the very first chunk
-                                if is_first_chunk:
-                                    chunk = chunk_data[byte_offset_in_chunk:]
-                                    is_first_chunk = False
-                                else:
-                                    chunk = chunk_data
-
-                                # Prevent overshooting
-                                remaining_bytes = bytes_to_send - bytes_sent
-                                if len(chunk) > remaining_bytes:
-                                    chunk = chunk[:remaining_bytes]
-
-                                yield chunk
-                                bytes_sent += len(chunk)
-                                current_chunk_index += 1
-
-                                if bytes_sent >= bytes_to_send:
-                                    break
-
-                            # ✅ Success, exit retry loop
-                            break
-
-                        except (FloodWait, Timeout, RPCError, AuthBytesInvalid, FileReferenceExpired) as e:
-                            logger.warning(f"Worker {worker.worker_id} failed with {e.__class__.__name__}. Putting on cooldown.")
-                            worker_manager.release_worker(worker.worker_id)
-                            worker_manager.put_worker_on_cooldown(worker.worker_id)
-                            
-                            # Try to get a new worker
-                            new_worker = worker_manager.get_worker()
-                            if not new_worker:
-                                raise HTTPException(status_code=503, detail="All workers are busy or down.")
-                            
-                            worker = new_worker
-                            logger.info(f"Switched to new worker {worker.worker_id}. Re-fetching message to refresh file reference.")
-                            
-                            try:
-                                message = await worker.get_messages(chat_id=channel_id, message_ids=message_id)
-                                if not message:
-                                    raise HTTPException(status_code=404, detail="File not found during re-fetch.")
-                            except Exception as re_fetch_error:
-                                logger.error(f"Failed to re-fetch message with new worker {worker.worker_id}: {re_fetch_error}")
-                                worker_manager.release_worker(worker.worker_id)
-                                worker_manager.put_worker_on_cooldown(worker.worker_id)
-                                continue # Try next retry attempt with potentially another worker
-
-                            continue
-
-                        except Exception as e:
-                            logger.error(f"Unexpected error with worker {worker.worker_id}: {e}", exc_info=True)
-                            worker_manager.put_worker_on_cooldown(worker.worker_id)
-                            raise HTTPException(status_code=500, detail="Unexpected error during streaming.")
-                else:
-                    # Cache hit: Serve the chunk from the cache
-                    if is_first_chunk:
-                        chunk = chunk[byte_offset_in_chunk:]
-                        is_first_chunk = False
-
-                    remaining_bytes = bytes_to_send - bytes_sent
-                    if len(chunk) > remaining_bytes:
-                        chunk = chunk[:remaining_bytes]
+                while next_to_fetch <= last_chunk_index and len(pending) <= READ_AHEAD_CHUNKS:
+                    source = "cache" if (file_key, next_to_fetch) in cache else "telegram"
+                    run_length = min(max_run_length, max(1, next_to_fetch - chunk_offset), last_chunk_index - next_to_fetch + 1)
+                    pending.append((next_to_fetch, source, asyncio.ensure_future(get_chunk(next_to_fetch, run_length))))
+                    next_to_fetch += 1
+                if not pending:
+                    break
 
-                    yield chunk
-                    bytes_sent += len(chunk)
-                    current_chunk_index += 1
+                _, source, task = pending.popleft()
+                chunk = await task
+                if not chunk:
+                    break
+                if bytes_sent == 0:
+                    metrics.STREAM_TTFB.observe(time.monotonic() - request.state.started)
+
+                # Handle byte offset on the very first chunk
+                if is_first_chunk:
+                    chunk = chunk[byte_offset_in_chunk:]
+                    is_first_chunk = False
+
+                # Prevent overshooting
+                remaining_bytes = bytes_to_send - bytes_sent
+                if len(chunk) > remaining_bytes:
+                    chunk = chunk[:remaining_bytes]
+
+                if user_id is not None:
+                    await admission.throttle(user_id, len(chunk))
+                yield chunk
+                bytes_sent += len(chunk)
+                metrics.BYTES_SERVED.inc(len(chunk), source=source)
         finally:
-            worker_manager.release_worker(worker.worker_id)
+            # Runs when the client disconnects or seeks away
+            closed = True
+            metrics.ACTIVE_STREAMS.dec()
+            for _, _, task in pending:
+                task.cancel()
+                if task.done() and not task.cancelled():
+                    task.exception()
+
+
+    return media_streamer
+
 
+class RangeStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse that closes its body and runs on_close once the response
+    is over, however it ended.
+    """
 
-    return media_streamer, start, end, file_size, file_name
+    def __init__(self, *args, on_close=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.on_close = on_close
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            try:
+                # Starlette leaves the body open when the client goes away; closing it
+                # stops its prefetches now instead of whenever it is garbage collected
+                await self.body_iterator.aclose()
+            finally:
+                if self.on_close:
+                    self.on_close()
 
 
 @api.get("/stream/{file_link}")
@@ -206,60 +601,19 @@ async def stream_file(file_link: str, request: Request):
     if not await is_user_authorized(user_id, otp):
         raise HTTPException(status_code=403, detail="Unauthorized user or subscription expired")
 
-    file_doc = await files_col.find_one({"_id": ObjectId(_id)})
+    file_doc = await get_file_doc(_id)
 
     if not file_doc:
         raise HTTPException(status_code=403, detail="Stream Not Available")
 
-    # If it's a HEAD request, we can release early without getting the full stream
-    if request.method == "HEAD":
-        worker_manager = get_worker_manager()
-        message = None
-        worker = None
-        for _ in range(MAX_RETRIES):
-            worker = worker_manager.get_worker()
-            if not worker:
-                raise HTTPException(status_code=503, detail="All workers are busy.")
-            try:
-                message = await worker.get_messages(chat_id=file_doc['channel_id'], message_ids=file_doc['message_id'])
-                if message:
-                    break
-            except (FloodWait, Timeout, RPCError, AuthBytesInvalid, FileReferenceExpired):
-                worker_manager.release_worker(worker.worker_id)
-                worker_manager.put_worker_on_cooldown(worker.worker_id)
-                continue
-            except ChannelInvalid:
-                worker_manager.release_worker(worker.worker_id)
-                raise HTTPException(status_code=404, detail="Channel not found")
-            except Exception as e:
-                worker_manager.release_worker(worker.worker_id)
-                worker_manager.put_worker_on_cooldown(worker.worker_id)
-                raise HTTPException(status_code=500, detail=f"Worker error: {e}")
-        
-        if not message:
-            if worker:
-                worker_manager.release_worker(worker.worker_id)
-            raise HTTPException(status_code=404, detail="File not found after retries.")
-
-        _, file_size = await get_file_properties(message)
-        worker_manager.release_worker(worker.worker_id)
-        return Response(status_code=200, headers={"Content-Length": str(file_size), "Accept-Ranges": "bytes"})
-
-    media_streamer, start, end, file_size, file_name = await get_file_stream(file_doc['channel_id'], file_doc['message_id'], request)
-
-    mime_type, _ = mimetypes.guess_type(file_name)
-    if mime_type is None:
-        mime_type = "video/mp4"
-
+    current_user.set(user_id)
+    file_meta = await get_file_meta(file_doc)
+    file_name = file_meta["file_name"]
     headers = {
-        "Content-Type": mime_type,
-        "Accept-Ranges": "bytes",
-        "Content-Length": str(end - start + 1),
-        "Content-Range": f"bytes {start}-{end}/{file_size}",
+        "Content-Type": file_meta["mime_type"] or "video/mp4",
         "Content-Disposition": f'attachment; filename="{file_name}"'
     }
-    
-    return StreamingResponse(media_streamer(), status_code=206 if start > 0 else 200, headers=headers)
+    return await send_file(request, file_doc, headers, count_play=True, user_id=user_id)
 
 '''
 @api.get("/download/{file_link}")
@@ -282,17 +636,53 @@ async def serve_subtitle(file_link: str, request: Request):
     if not await is_user_authorized(user_id, otp):
         raise HTTPException(status_code=403, detail="Unauthorized user or subscription expired")
 
-    file_doc = await files_col.find_one({"_id": ObjectId(_id)})
+    file_doc = await get_file_doc(_id)
 
     if not file_doc:
          raise HTTPException(status_code=403, detail="Subtitle not available")
 
-    media_streamer, _, _, file_size, _ = await get_file_stream(file_doc['channel_id'], file_doc['message_id'], request)
-    headers = {
-        "Content-Type": "application/x-subrip",
-        "Content-Length": str(file_size),
-    }
-    return StreamingResponse(media_streamer(), headers=headers)
+    return await send_file(request, file_doc, {"Content-Type": "application/x-subrip"})
+
+# Keyframe segments by file key; playlists differ per viewer only by the link
+hls_segments = TTLCache(HLS_INDEX_CACHE_SIZE, HLS_INDEX_CACHE_TTL)
+
+async def get_hls_segments(file_doc, file_meta):
+    """Returns the file's keyframe segments, locating them on first use, or None when no playlist can be built."""
+    channel_id, message_id = file_doc['channel_id'], file_doc['message_id']
+    file_key = f"{channel_id}_{message_id}"
+    segments = hls_segments.get(file_key)
+    if segments is None:
+        container = file_meta.get("container")
+        if container and (container["format"] != "mp4" or container.get("fragmented") is False):
+            # Already parsed when the file was first opened, no need to read it again
+            return None
+        fetch = fetch_chunks_via_coordinator if STREAM_ROLE == "edge" else fetch_chunks
+        segments = await locate_segments(channel_id, message_id, file_meta["file_size"], fetch)
+        if segments is not None:
+            hls_segments.set(file_key, segments)
+    return segments
+
+@api.get("/hls/{file_link}")
+async def serve_hls_playlist(file_link: str):
+    _id, user_id, otp = await decode_file_link(file_link)
+    if not await is_user_authorized(user_id, otp):
+        raise HTTPException(status_code=403, detail="Unauthorized user or subscription expired")
+
+    file_doc = await get_file_doc(_id)
+
+    if not file_doc:
+        raise HTTPException(status_code=403, detail="Stream Not Available")
+
+    segments = await get_hls_segments(file_doc, await get_file_meta(file_doc))
+    if segments is None:
+        raise HTTPException(status_code=415, detail="Playlists are only built for fragmented MP4 with a segment index")
+
+    # Segments are byte ranges of /stream, so they are served from the chunk cache
+    return Response(
+        hls_playlist(segments, f"/stream/{file_link}"),
+        media_type="application/vnd.apple.mpegurl",
+        headers={"Cache-Control": STREAM_CACHE_CONTROL},
+    )
 
 @api.get("/player/{file_link}")
 async def play_video(file_link: str):
@@ -307,65 +697,53 @@ async def get_file_details(file_link: str):
     if not await is_user_authorized(user_id, otp):
         raise HTTPException(status_code=403, detail="Unauthorized user or subscription expired")
 
-    file_doc = await files_col.find_one({"_id": ObjectId(_id)})
+    file_doc = await get_file_doc(_id)
 
     if not file_doc:
          raise HTTPException(status_code=403, detail="Details not available")
 
-    worker_manager = get_worker_manager()
-    message = None
-    worker = None
-
-    for _ in range(MAX_RETRIES):
-        worker = worker_manager.get_worker()
-        if not worker:
-            raise HTTPException(status_code=503, detail="All workers are busy.")
-
-        try:
-            message = await worker.get_messages(chat_id=file_doc['channel_id'], message_ids=file_doc['message_id'])
-            if message:
-                break
-        except (FloodWait, Timeout, RPCError, AuthBytesInvalid, FileReferenceExpired):
-            worker_manager.release_worker(worker.worker_id)
-            worker_manager.put_worker_on_cooldown(worker.worker_id)
-            continue
-        except ChannelInvalid:
-            worker_manager.release_worker(worker.worker_id)
-            raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail="Channel not found")
-        except Exception as e:
-            worker_manager.release_worker(worker.worker_id)
-            worker_manager.put_worker_on_cooldown(worker.worker_id)
-            raise HTTPException(status_code=500, detail=f"Worker error: {e}")
+    file_meta = await get_file_meta(file_doc)
+    file_name, file_size = file_meta["file_name"], file_meta["file_size"]
+    mime_type = file_meta["mime_type"] or "video/mp4"
 
-    if not message:
-        if worker:
-            worker_manager.release_worker(worker.worker_id)
-        raise HTTPException(status_code=404, detail="File not found after retries.")
-    
-    worker_manager.release_worker(worker.worker_id)
-
-    file_name, file_size = await get_file_properties(message)
-    mime_type, _ = mimetypes.guess_type(file_name)
-    if mime_type is None:
-        mime_type = "video/mp4"
-
-    # Subtitle search logic
     subtitle_url = None
-    subtitle_name = f"{file_name}.srt"
-    
-    subtitle_doc = await files_col.find_one({"file_name": subtitle_name})
-    if subtitle_doc:
-        bot_instance = Bot("temp_instance")
-        subtitle_link = bot_instance.encode_file_link(subtitle_doc['channel_id'], subtitle_doc['message_id'], user_id)
+    subtitle = await get_subtitle(file_doc, file_name)
+    if subtitle:
+        subtitle_link = encode_file_link(subtitle['_id'], user_id, otp)
         subtitle_url = f"/subtitle/{subtitle_link}"
 
+    # Only from the container recorded by the background indexing: /details never downloads
+    hls_url = None
+    if (file_meta.get("container") or {}).get("fragmented"):
+        hls_url = f"/hls/{file_link}"
+
     return JSONResponse({
         "file_name": file_name,
         "file_size": human_readable_size(file_size),
         "mime_type": mime_type,
+        "hls_url": hls_url,
         "subtitle_url": subtitle_url
     })
     
+@api.get("/search")
+async def search(q: str, user_id: int, otp: str, page: int = 1, per_page: int = SEARCH_RESULTS_PER_PAGE):
+    if not await is_user_authorized(user_id, otp):
+        raise HTTPException(status_code=403, detail="Unauthorized user or subscription expired")
+
+    page = max(1, page)
+    per_page = max(1, min(per_page, SEARCH_MAX_PER_PAGE))
+    total, results = search_files(q, (page - 1) * per_page, per_page)
+
+    files = []
+    for _id, file_name in results:
+        file_link = encode_file_link(_id, user_id, otp)
+        files.append({
+            "file_name": file_name,
+            "stream_url": f"/stream/{file_link}",
+            "details_url": f"/details/{file_link}",
+        })
+    return JSONResponse({"query": q, "page": page, "per_page": per_page, "total": total, "results": files})
+
 @api.get("/play/{player}/{file_link}")
 async def play_in_player(player: str, file_link: str):
     _, user_id, otp = await decode_file_link(file_link)
@@ -8,8 +8,10 @@ from pyrogram import Client, filters, enums
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, ChatPrivileges
 from pyrogram.errors import RPCError, BotMethodInvalid
 from config import OWNER_ID
-from app import bot, worker_bots
-from utility import auto_delete_message
+from app import bot, worker_bots, cache
+from db import files_col
+from utility import auto_delete_message, extract_channel_and_msg_id, human_readable_size
+from warmer import warmer, PINNED
 
 @bot.on_message(filters.command("add_workers") & filters.private & filters.user(OWNER_ID))
 async def add_workers_command(client: Client, message: Message):
@@ -54,3 +56,39 @@ async def send_log_file(client, message: Message):
         bot.loop.create_task(auto_delete_message(message, reply))
     except Exception as e:
         pass
+
+async def find_linked_file(message: Message):
+    """Resolves the t.me/c link given to an owner command to its files_col document."""
+    if len(message.command) < 2:
+        await message.reply_text(f"Usage: /{message.command[0]} <t.me/c/... message link>")
+        return None
+    try:
+        channel_id, message_id = extract_channel_and_msg_id(message.command[1])
+    except ValueError as e:
+        await message.reply_text(str(e))
+        return None
+    file_doc = await files_col.find_one({"channel_id": channel_id, "message_id": message_id})
+    if not file_doc:
+        await message.reply_text("File not found.")
+    return file_doc
+
+@bot.on_message(filters.command("warm") & filters.private & filters.user(OWNER_ID))
+async def warm_command(client, message: Message):
+    file_doc = await find_linked_file(message)
+    if file_doc:
+        warmer.enqueue(str(file_doc["_id"]), PINNED, whole=True)
+        await message.reply_text(f"Warming <b>{file_doc.get('file_name')}</b> into the cache.")
+
+@bot.on_message(filters.command(["pin", "unpin"]) & filters.private & filters.user(OWNER_ID))
+async def pin_command(client, message: Message):
+    file_doc = await find_linked_file(message)
+    if file_doc:
+        pinned = message.command[0] == "pin"
+        if not await warmer.pin(file_doc, pinned):
+            await message.reply_text(
+                f"<b>{file_doc.get('file_name')}</b> was not pinned: pinned files may take up to "
+                f"{human_readable_size(cache.store.pin_limit)} of the cache."
+            )
+            return
+        state = "kept fully cached" if pinned else "no longer pinned"
+        await message.reply_text(f"<b>{file_doc.get('file_name')}</b> is {state}.")
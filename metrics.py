@@ -0,0 +1,181 @@
+import time
+import bisect
+from pymongo import monitoring
+
+# Latency buckets in seconds, from cache hits to slow Telegram round trips
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(process_labels) + list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        registry.append(self)
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labelnames)
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, _format_labels(self.labelnames, key), value
+
+    def sample_lines(self):
+        return [f"{name}{labels} {value}" for name, labels, value in self.samples()]
+
+    def render(self, others=()):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines += self.sample_lines()
+        for other in others:
+            lines += other.get(self.name, [])
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        """Mirrors a monotonically increasing count kept elsewhere."""
+        self.values[self._key(labels)] = value
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        state = self.values.get(key)
+        if state is None:
+            state = self.values[key] = [[0] * len(self.buckets), 0, 0.0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            state[0][index] += 1
+        state[1] += 1
+        state[2] += value
+
+    def samples(self):
+        for key, (bucket_counts, count, total) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", _format_labels(self.labelnames, key, ("le", bound)), cumulative
+            yield f"{self.name}_bucket", _format_labels(self.labelnames, key, ("le", "+Inf")), count
+            yield f"{self.name}_count", _format_labels(self.labelnames, key), count
+            yield f"{self.name}_sum", _format_labels(self.labelnames, key), total
+
+
+registry = []
+# Callables run before each scrape to refresh gauges that mirror other state
+collectors = []
+# Labels on every sample of this process. With STREAM_PROCESSES > 1 each edge
+# process is labelled process="edge-<pid>" and the coordinator process="coordinator";
+# a scrape reaches one edge behind the shared port, which adds the coordinator's
+# samples (workers, warming, shared cache) to its own. Other edges' series show up
+# only when a scrape lands on them, so aggregate them with sum by (...) over
+# rates rather than reading one series.
+process_labels = ()
+
+
+def snapshot():
+    """{metric name: sample lines} of this process, for another process to merge into its scrape."""
+    for collect in collectors:
+        collect()
+    return {metric.name: metric.sample_lines() for metric in registry}
+
+
+def render(others=()):
+    """Text exposition of this process's metrics plus the snapshots in others."""
+    for collect in collectors:
+        collect()
+    return "\n".join(metric.render(others) for metric in registry) + "\n"
+
+
+REQUEST_LATENCY = Histogram(
+    "streambot_request_duration_seconds", "Time until response headers, by route.", ("method", "route", "status"))
+STREAM_TTFB = Histogram("streambot_stream_ttfb_seconds", "Time to first body byte of /stream responses.")
+ACTIVE_STREAMS = Gauge("streambot_active_streams", "Streaming responses currently being sent.")
+BYTES_SERVED = Counter("streambot_bytes_served_total", "Response body bytes, by where the chunk came from.", ("source",))
+CACHE_LOOKUPS = Counter("streambot_cache_lookups_total", "Chunk cache lookups, by tier and result.", ("tier", "result"))
+CACHE_HIT_RATIO = Gauge("streambot_cache_hit_ratio", "Share of chunk lookups answered by either cache tier.")
+CACHE_BYTES = Gauge("streambot_cache_bytes", "Bytes held by each cache tier.", ("tier",))
+WORKER_IN_FLIGHT = Gauge("streambot_worker_in_flight", "Slots held on each worker.", ("worker",))
+WORKER_COOLDOWN = Gauge("streambot_worker_cooldown_seconds", "Seconds left on each worker's cooldown.", ("worker",))
+WORKER_LATENCY = Gauge("streambot_worker_chunk_latency_seconds", "Moving average chunk download time.", ("worker",))
+WORKER_THROUGHPUT = Gauge("streambot_worker_bytes_per_second", "Recent download rate of each worker.", ("worker",))
+WORKER_ERROR_RATE = Gauge("streambot_worker_error_rate", "Moving average share of failed requests.", ("worker",))
+SHED_REQUESTS = Counter("streambot_shed_requests_total", "Requests refused with 429, by reason.", ("reason",))
+MONGO_LATENCY = Histogram("streambot_mongo_command_duration_seconds", "MongoDB command latency.", ("command", "outcome"))
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Times every command the driver sends, including those made by motor."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_LATENCY.observe(event.duration_micros / 1e6, command=event.command_name, outcome="ok")
+
+    def failed(self, event):
+        MONGO_LATENCY.observe(event.duration_micros / 1e6, command=event.command_name, outcome="error")
+
+
+def collect_cache(cache):
+    stats = cache.stats
+    for tier in ("memory", "disk"):
+        CACHE_LOOKUPS.set(stats[f"{tier}_hits"], tier=tier, result="hit")
+        CACHE_LOOKUPS.set(stats[f"{tier}_misses"], tier=tier, result="miss")
+    lookups = stats["memory_hits"] + stats["memory_misses"]
+    if lookups:
+        CACHE_HIT_RATIO.set((stats["memory_hits"] + stats["disk_hits"]) / lookups)
+    CACHE_BYTES.set(cache.memory.size, tier="memory")
+    CACHE_BYTES.set(cache.store.size, tier="disk")
+
+
+def collect_workers(worker_manager):
+    now = time.monotonic()
+    for worker_id, tasks in worker_manager.worker_tasks.items():
+        stats = worker_manager.stats[worker_id]
+        WORKER_IN_FLIGHT.set(tasks, worker=worker_id)
+        WORKER_COOLDOWN.set(max(0.0, worker_manager.cooldowns.get(worker_id, now) - now), worker=worker_id)
+        WORKER_LATENCY.set(stats["latency"], worker=worker_id)
+        WORKER_THROUGHPUT.set(stats["bytes_per_second"], worker=worker_id)
+        WORKER_ERROR_RATE.set(stats["error_rate"], worker=worker_id)
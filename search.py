@@ -0,0 +1,217 @@
+import time
+import heapq
+import bisect
+import asyncio
+import logging
+from array import array
+from app import bot
+from db import files_col
+from config import SEARCH_INDEX_INTERVAL, SEARCH_REBUILD_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+MAX_EXPANSIONS = 20  # vocabulary terms a single query word may match
+MIN_SIMILARITY = 0.3  # trigram similarity a misspelt word needs to match a term
+EXACT_WEIGHT, PREFIX_WEIGHT, FUZZY_WEIGHT = 1.0, 0.8, 0.6
+FREQUENT_SHARE = 0.2  # a query whose rarest word matches more of the files than this is sampled
+FREQUENT_MIN_FILES = 20000  # ... once that word matches at least this many
+FREQUENT_POOL = 1000  # newest matching files a sampled query ranks
+FREQUENT_SCAN = 10000  # most files a sampled query checks to fill that pool
+PROBE_RATIO = 20  # postings this many times longer than the candidates are probed, not scanned
+
+
+def contains(postings, doc):
+    i = bisect.bisect_left(postings, doc)
+    return i < len(postings) and postings[i] == doc
+
+
+def trigrams(term):
+    padded = f" {term} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class SearchIndex:
+    """
+    Inverted index over file names normalized with Bot.sanitize_query.
+    Each query word matches vocabulary terms exactly, by prefix or, failing both,
+    by trigram similarity; a file must match every word. Trigrams index the
+    vocabulary rather than the files, which keeps the index small.
+    """
+
+    def __init__(self):
+        self.ids = []           # doc number -> files_col _id as a string
+        self.names = []         # doc number -> file_name
+        self.terms = {}         # term -> term number
+        self.vocabulary = []    # term number -> term
+        self.postings = []      # term number -> ascending doc numbers
+        self.term_trigrams = {}  # trigram -> term numbers
+        self.sorted_terms = []  # vocabulary in order, for prefix matches
+        self.last_id = None
+
+    def add(self, _id, file_name):
+        doc = len(self.ids)
+        self.ids.append(_id)
+        self.names.append(file_name)
+        for term in set(bot.sanitize_query(file_name).split()):
+            number = self.terms.get(term)
+            if number is None:
+                number = self.terms[term] = len(self.vocabulary)
+                self.vocabulary.append(term)
+                self.postings.append(array("I"))
+                for gram in trigrams(term):
+                    self.term_trigrams.setdefault(gram, array("I")).append(number)
+            self.postings[number].append(doc)
+
+    async def load(self):
+        """Adds files indexed since the last load, in _id order."""
+        query = {"file_name": {"$not": {"$regex": r"\.srt$", "$options": "i"}}}
+        if self.last_id:
+            query["_id"] = {"$gt": self.last_id}
+        vocabulary_size = len(self.vocabulary)
+        cursor = files_col.find(query, {"file_name": 1}).sort("_id", 1)
+        async for file_doc in cursor:
+            self.last_id = file_doc["_id"]
+            if file_doc.get("file_name"):
+                self.add(str(file_doc["_id"]), file_doc["file_name"])
+        if len(self.vocabulary) != vocabulary_size:
+            self.sorted_terms = sorted(self.vocabulary)
+
+    def expand(self, word):
+        """Returns {term number: weight} of the terms a query word matches."""
+        matches = {}
+        number = self.terms.get(word)
+        if number is not None:
+            matches[number] = EXACT_WEIGHT
+        start = bisect.bisect_left(self.sorted_terms, word)
+        for term in self.sorted_terms[start:start + MAX_EXPANSIONS]:
+            if not term.startswith(word):
+                break
+            matches.setdefault(self.terms[term], PREFIX_WEIGHT)
+        if matches or len(word) < 3:
+            return matches
+
+        # Typos: terms sharing enough trigrams with the word
+        grams = trigrams(word)
+        shared = {}
+        for gram in grams:
+            for number in self.term_trigrams.get(gram, ()):
+                shared[number] = shared.get(number, 0) + 1
+        similar = []
+        for number, count in shared.items():
+            # A term of n characters has n padded trigrams, barring repeats
+            similarity = count / (len(grams) + len(self.vocabulary[number]) - count)
+            if similarity >= MIN_SIMILARITY:
+                similar.append((similarity, number))
+        for similarity, number in heapq.nlargest(MAX_EXPANSIONS, similar):
+            matches[number] = FUZZY_WEIGHT * similarity
+        return matches
+
+    def weight(self, doc, matches):
+        """Returns the best weight among the matched terms containing doc, or None."""
+        best = None
+        for number, weight in matches.items():
+            if (best is None or weight > best) and contains(self.postings[number], doc):
+                best = weight
+        return best
+
+    def score(self, expansions):
+        """Returns {doc: score} of the files matching every word, rarest word first."""
+        # Intersect the others into the first word's files, lowest weights
+        # first so each file keeps its best match
+        scores = {}
+        for number, weight in sorted(expansions[0].items(), key=lambda item: item[1]):
+            scores.update(dict.fromkeys(self.postings[number], weight))
+        for matches in expansions[1:]:
+            candidates = set(scores)
+            narrowed = {}
+            for number, weight in sorted(matches.items(), key=lambda item: item[1]):
+                postings = self.postings[number]
+                if len(postings) > PROBE_RATIO * len(candidates):
+                    common = [doc for doc in candidates if contains(postings, doc)]
+                else:
+                    common = candidates.intersection(postings)
+                narrowed.update({doc: scores[doc] + weight for doc in common})
+            scores = narrowed
+        return scores
+
+    def sample(self, expansions, wanted):
+        """
+        Returns ({doc: score}, estimated total) for the newest files matching
+        every word, stopping after max(wanted, FREQUENT_POOL) of them or
+        FREQUENT_SCAN files of the first word.
+        """
+        first, rest = expansions[0], expansions[1:]
+        wanted = max(wanted, FREQUENT_POOL)
+        scores = {}
+        scanned = 0
+        previous = None
+        for doc in heapq.merge(*(reversed(self.postings[number]) for number in first), reverse=True):
+            if doc == previous:
+                continue
+            previous = doc
+            scanned += 1
+            score = self.weight(doc, first)
+            for matches in rest:
+                weight = self.weight(doc, matches)
+                if weight is None:
+                    break
+                score += weight
+            else:
+                scores[doc] = score
+                if len(scores) >= wanted:
+                    break
+            if scanned >= FREQUENT_SCAN:
+                break
+        else:
+            return scores, len(scores)
+        size = sum(len(self.postings[number]) for number in first)
+        return scores, max(len(scores), round(len(scores) * size / scanned))
+
+    def search(self, query, offset=0, limit=10):
+        """
+        Returns (total matches, [(_id, file_name)]) for one page of ranked results.
+        A query whose rarest word matches a large share of the files (e.g. "mkv"
+        or "1080p mkv") ranks only the newest matches and estimates the total.
+        """
+        words = list(dict.fromkeys(bot.sanitize_query(query).split()))
+        expansions = [self.expand(word) for word in words]
+        if not expansions or not all(expansions):
+            return 0, []
+
+        sizes = [sum(len(self.postings[number]) for number in matches) for matches in expansions]
+        expansions = [matches for _, matches in sorted(zip(sizes, expansions), key=lambda item: item[0])]
+        if min(sizes) < max(FREQUENT_MIN_FILES, FREQUENT_SHARE * len(self.ids)):
+            scores = self.score(expansions)
+            total = len(scores)
+        else:
+            scores, total = self.sample(expansions, offset + limit)
+
+        # Best score first, then the shortest (closest) name, then the newest file
+        names = self.names
+        ranked = heapq.nsmallest(offset + limit, scores, key=lambda doc: (-scores[doc], len(names[doc]), -doc))
+        return total, [(self.ids[doc], names[doc]) for doc in ranked[offset:]]
+
+
+index = SearchIndex()
+
+
+def search_files(query, offset=0, limit=10):
+    return index.search(query, offset, limit)
+
+
+async def search_indexer():
+    """Background task adding new files to the index and rebuilding it from scratch now and then."""
+    global index
+    rebuilt_at = time.monotonic()
+    while True:
+        try:
+            if time.monotonic() - rebuilt_at >= SEARCH_REBUILD_INTERVAL:
+                fresh = SearchIndex()
+                await fresh.load()
+                index = fresh
+                rebuilt_at = time.monotonic()
+            else:
+                await index.load()
+        except Exception as e:
+            logger.error(f"Search indexing failed: {e}")
+        await asyncio.sleep(SEARCH_INDEX_INTERVAL)
@@ -5,7 +5,9 @@ import asyncio
 import base64
 import logging
 from config import *
-from db import auth_users_col
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from db import auth_users_col, files_col
 # =========================
 # Constants & Globals
 # =========================
@@ -15,23 +17,209 @@ AUTO_DELETE_SECONDS = 2 * 60
 logger = logging.getLogger(__name__)
 
 
-import diskcache as dc
+import time
 import asyncio
+from functools import partial
+from contextlib import aclosing
+from collections import OrderedDict
+from chunk_store import ChunkStore
+
+class MemoryCache:
+    """In-process LRU of chunk bytes bounded by total size."""
+
+    def __init__(self, size_limit):
+        self.size_limit = size_limit
+        self.size = 0
+        self.data = OrderedDict()
+
+    def get(self, key):
+        value = self.data.get(key)
+        if value is not None:
+            self.data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if len(value) > self.size_limit:
+            return
+        old = self.data.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.data[key] = value
+        self.size += len(value)
+        while self.size > self.size_limit:
+            _, evicted = self.data.popitem(last=False)
+            self.size -= len(evicted)
+
 
 class Cache:
-    def __init__(self, directory, size_limit):
-        self.cache = dc.Cache(directory, size_limit=size_limit, eviction_policy='least-recently-used')
+    """
+    Chunk cache addressed by file key ("{channel_id}_{message_id}") and chunk index,
+    plus one metadata record per file. A small memory tier sits in front of the
+    on-disk segments for the chunks every player re-reads.
+    """
+
+    def __init__(self, directory, size_limit, chunk_size, memory_size_limit=0, readonly=False):
+        self.store = ChunkStore(directory, size_limit, chunk_size, readonly, int(size_limit * PIN_CACHE_SHARE))
+        self.memory = MemoryCache(memory_size_limit)
+        # Chunks hit once on disk; a second hit earns them a place in memory
+        self.seen = OrderedDict()
+        # In-flight fetches keyed like the cache, so concurrent misses share one download
+        self.inflight = {}
+        # Batched downloads filling several chunks' futures, kept alive until done
+        self.runs = set()
+        self.stats = {"memory_hits": 0, "memory_misses": 0, "disk_hits": 0, "disk_misses": 0}
+
+    def _admit(self, file_key, index):
+        """
+        Head and tail chunks always go to memory, anything else once it proves popular.
+        Pinned chunks are not special here: pins protect the disk tier only.
+        """
+        if index < HOT_HEAD_CHUNKS:
+            return True
+        meta = self.store.get_meta(file_key)
+        if meta and index >= meta["chunk_count"] - HOT_TAIL_CHUNKS:
+            return True
+        key = (file_key, index)
+        if key in self.seen:
+            del self.seen[key]
+            return True
+        self.seen[key] = None
+        if len(self.seen) > HOT_SEEN_ENTRIES:
+            self.seen.popitem(last=False)
+        return False
+
+    async def get(self, file_key, index, promote=True):
+        """
+        Returns the chunk or None. With promote False, a disk hit neither counts
+        toward nor earns a place in the memory tier, for callers that only need
+        the chunk on disk.
+        """
+        key = (file_key, index)
+        value = self.memory.get(key)
+        if value is not None:
+            self.stats["memory_hits"] += 1
+            return value
+        self.stats["memory_misses"] += 1
+
+        value = self.store.get(file_key, index)
+        if value is None:
+            self.stats["disk_misses"] += 1
+            return None
+        self.stats["disk_hits"] += 1
+        if promote and self.memory.size_limit and self._admit(file_key, index):
+            value = bytes(value)
+            self.memory.put(key, value)
+        return value
+
+    async def put(self, file_key, index, value):
+        await self.store.put(file_key, index, value)
+        if self.memory.size_limit and self._admit(file_key, index):
+            self.memory.put((file_key, index), bytes(value))
+
+    async def get_meta(self, file_key):
+        return self.store.get_meta(file_key)
+
+    async def put_meta(self, file_key, meta):
+        self.store.put_meta(file_key, meta)
+
+    async def get_or_fetch_run(self, file_key, index, count, fetch_run, promote=True):
+        """
+        Returns the cached chunk, looked up with get(promote=promote). A miss downloads up to count consecutive chunks
+        through one fetch_run(index, count) call, an async generator of chunks;
+        the run stops short of chunks already cached or being fetched.
+        Concurrent callers missing on a chunk of the run await that chunk alone.
+        """
+        key = (file_key, index)
+        task = self.inflight.get(key)
+        if task is None or task.done():
+            value = await self.get(file_key, index, promote)
+            if value is not None:
+                return value
+            task = self.inflight.get(key)
+        if task is None or task.done():
+            loop = asyncio.get_running_loop()
+            futures = []
+            for run_index in range(index, index + count):
+                run_key = (file_key, run_index)
+                if futures and (run_key in self or run_key in self.inflight):
+                    break
+                future = loop.create_future()
+                future.add_done_callback(partial(self._forget, run_key))
+                self.inflight[run_key] = future
+                futures.append(future)
+            run = asyncio.ensure_future(self._fetch_run(file_key, index, futures, fetch_run))
+            self.runs.add(run)
+            run.add_done_callback(self.runs.discard)
+            task = futures[0]
+        # Shield so one client disconnecting doesn't cancel the fetch for the others
+        return await asyncio.shield(task)
 
-    async def get(self, key):
-        return await asyncio.to_thread(self.cache.get, key)
+    async def _fetch_run(self, file_key, index, futures, fetch_run):
+        done = 0
+        try:
+            async with aclosing(fetch_run(index, len(futures))) as chunks:
+                async for value in chunks:
+                    await self.put(file_key, index + done, value)
+                    futures[done].set_result(value)
+                    done += 1
+                    if done == len(futures):
+                        break
+        except Exception as e:
+            if done < len(futures):
+                futures[done].set_exception(e)
+                done += 1
+        finally:
+            # Chunks the run never reached: their waiters fetch them on their own
+            for future in futures[done:]:
+                if not future.done():
+                    future.set_result(None)
 
-    async def put(self, key, value):
-        await asyncio.to_thread(self.cache.set, key, value)
+    def _forget(self, key, task):
+        if self.inflight.get(key) is task:
+            del self.inflight[key]
+        if not task.cancelled():
+            # Mark the exception as retrieved if every waiter went away
+            task.exception()
 
     def __contains__(self, key):
-        # Note: This is a blocking operation. Use with caution in async code.
-        # The primary get/put operations are now async.
-        return key in self.cache
+        file_key, index = key
+        return key in self.memory.data or self.store.has(file_key, index)
+
+class TTLCache:
+    """A small in-process LRU mapping whose entries expire after a time-to-live."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self.data.get(key)
+        if item is None:
+            return default
+        value, expires_at = item
+        if expires_at <= time.monotonic():
+            del self.data[key]
+            return default
+        self.data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        self.data[key] = (value, time.monotonic() + ttl)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self.data.pop(key, None)
+        return default if item is None else item[0]
+
+    def clear(self):
+        self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
 
 # =========================
 # Link & URL Utilities
@@ -92,6 +280,11 @@ async def auto_delete_message(user_message, bot_message):
     except Exception as e:
         pass
 
+def encode_file_link(file_id, user_id, otp):
+    """Encodes a file link in the format decode_file_link expects."""
+    raw = f"{file_id}_{user_id}_{otp}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
 async def decode_file_link(encoded_link):
     """
     Decodes the base64 encoded link into its components.
@@ -103,27 +296,147 @@ async def decode_file_link(encoded_link):
         file_id, user_id, token = decoded_str.split("_")
         return file_id, int(user_id), token
     except Exception as e:
-        logger.error(f"Error decoding file link: {e}")
+        logger.warning(f"Error decoding file link: {e}")
         return None, None, None
 
 
+# Authorization decisions, so a video session's range requests don't each query Mongo
+auth_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+
+
+def invalidate_authorization(user_id, otp=None):
+    """Forgets cached decisions for a user, e.g. after their access was revoked or renewed."""
+    if otp is not None:
+        auth_cache.pop((user_id, otp))
+        return
+    for key in [k for k in auth_cache.data if k[0] == user_id]:
+        auth_cache.pop(key)
+
+
 async def is_user_authorized(user_id, otp):
     """Check if a user is authorized."""
+    cached = auth_cache.get((user_id, otp))
+    if cached is not None:
+        return cached
+
+    expiry = await fetch_authorization_expiry(user_id, otp)
+    if expiry is None:
+        auth_cache.set((user_id, otp), False, AUTH_NEGATIVE_CACHE_TTL)
+        return False
+
+    # Never trust a cached grant past the record's own expiry
+    remaining = (expiry - datetime.now(timezone.utc)).total_seconds()
+    if remaining <= 0:
+        auth_cache.set((user_id, otp), False, AUTH_NEGATIVE_CACHE_TTL)
+        return False
+    auth_cache.set((user_id, otp), True, min(AUTH_CACHE_TTL, remaining))
+    return True
+
+
+async def fetch_authorization_expiry(user_id, otp):
+    """Returns the latest expiry stored for (user_id, otp) as an aware datetime, or None."""
     query = {"user_id": user_id, "otp": otp}
     
     # Sort by expiry descending to handle potential duplicate records robustly
     doc = await auth_users_col.find(query).sort("expiry", -1).to_list(length=1)
     if not doc:
-        return False
+        return None
     doc = doc[0]
     expiry = doc["expiry"]
     if isinstance(expiry, str):
         try:
             expiry = datetime.fromisoformat(expiry)
         except Exception:
-            return False
-    if isinstance(expiry, datetime) and expiry.tzinfo is None:
+            return None
+    if not isinstance(expiry, datetime):
+        return None
+    if expiry.tzinfo is None:
         expiry = expiry.replace(tzinfo=timezone.utc)
-    if expiry < datetime.now(timezone.utc):
-        return False
-    return True
+    return expiry
+
+
+# File records by _id, loaded once so range requests for the same file skip Mongo
+file_cache = TTLCache(FILE_CACHE_SIZE, FILE_CACHE_TTL)
+subtitle_cache = TTLCache(FILE_CACHE_SIZE, FILE_CACHE_TTL)
+
+
+async def get_file_doc(_id):
+    """Returns the files_col document for an encoded file id, or None."""
+    file_doc = file_cache.get(_id)
+    if file_doc is None:
+        try:
+            object_id = ObjectId(_id)
+        except (InvalidId, TypeError):
+            return None
+        file_doc = await files_col.find_one({"_id": object_id})
+        if file_doc:
+            file_cache.set(_id, file_doc)
+    return file_doc
+
+
+async def get_subtitle(file_doc, file_name):
+    """
+    Returns the subtitle paired with a video as {_id, channel_id, message_id}, or None.
+    Pairs are precomputed by subtitle_indexer; the name lookup is only a fallback.
+    """
+    subtitle = file_doc.get("subtitle")
+    if subtitle:
+        return subtitle
+
+    subtitle_doc = await get_subtitle_doc(f"{file_name}.srt")
+    if not subtitle_doc:
+        return None
+    subtitle = {
+        "_id": subtitle_doc["_id"],
+        "channel_id": subtitle_doc["channel_id"],
+        "message_id": subtitle_doc["message_id"],
+    }
+    # Persist the pair so the next lookup is O(1) even after a restart
+    await files_col.update_one({"_id": file_doc["_id"]}, {"$set": {"subtitle": subtitle}})
+    file_doc["subtitle"] = subtitle
+    return subtitle
+
+
+async def pair_subtitles(after_id=None):
+    """
+    Stores each .srt document's location on the video it belongs to.
+    Only subtitles newer than after_id are processed; returns the last _id seen.
+    """
+    query = {"file_name": {"$regex": r"\.srt$", "$options": "i"}}
+    if after_id:
+        query["_id"] = {"$gt": after_id}
+    cursor = files_col.find(query, {"file_name": 1, "channel_id": 1, "message_id": 1}).sort("_id", 1)
+    async for srt_doc in cursor:
+        subtitle = {
+            "_id": srt_doc["_id"],
+            "channel_id": srt_doc["channel_id"],
+            "message_id": srt_doc["message_id"],
+        }
+        await files_col.update_many({"file_name": srt_doc["file_name"][:-4]}, {"$set": {"subtitle": subtitle}})
+        after_id = srt_doc["_id"]
+    return after_id
+
+
+async def subtitle_indexer():
+    """Background task pairing newly added subtitles with their videos."""
+    last_id = None
+    while True:
+        try:
+            last_id = await pair_subtitles(last_id)
+        except Exception as e:
+            logger.error(f"Subtitle indexing failed: {e}")
+        await asyncio.sleep(SUBTITLE_INDEX_INTERVAL)
+
+
+async def get_subtitle_doc(subtitle_name):
+    """Returns the files_col document of a subtitle by name, caching misses too."""
+    subtitle_doc = subtitle_cache.get(subtitle_name)
+    if subtitle_doc is None:
+        subtitle_doc = await files_col.find_one({"file_name": subtitle_name}) or {}
+        subtitle_cache.set(subtitle_name, subtitle_doc)
+    return subtitle_doc or None
+
+
+def invalidate_file_doc(_id):
+    """Forgets a cached file record after its document changed."""
+    file_cache.pop(str(_id))
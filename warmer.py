@@ -0,0 +1,185 @@
+import heapq
+import asyncio
+import logging
+from functools import partial
+from fastapi import HTTPException
+from app import cache, get_worker_manager
+from db import files_col
+from coordinator import coordinator
+from utility import get_file_doc, invalidate_file_doc
+from container import chunks_to_pin
+from config import (
+    WARM_INTERVAL, WARM_HEAD_CHUNKS, WARM_TAIL_CHUNKS, WARM_TRENDING_FILES,
+    WARM_RESERVED_SLOTS, MAX_BATCH_CHUNKS, CHUNK_SIZE,
+)
+
+logger = logging.getLogger(__name__)
+
+# Queue priorities, lowest first
+PINNED, TRENDING, NEW = 0, 1, 2
+
+
+class CacheWarmer:
+    """
+    Pre-fetches chunks into the cache before viewers ask for them: the head and
+    tail of newly added and trending files, and the whole of owner-pinned ones,
+    which are pinned in the chunk store within its pin budget. Whole files never
+    exceed that budget. Downloads only run while more than WARM_RESERVED_SLOTS
+    worker slots are free and nobody is queueing for one, so warming never
+    starves live streams.
+    """
+
+    def __init__(self):
+        self.queue = []  # (priority, sequence, file_id, whole)
+        self.queued = set()
+        self.sequence = 0
+        self.wakeup = asyncio.Event()
+        # Plays per file _id, halved every pass so old popularity fades
+        self.accesses = {}
+        self.last_id = None
+
+    def record_access(self, file_id):
+        self.accesses[file_id] = self.accesses.get(file_id, 0) + 1
+
+    async def merge_accesses(self, counts):
+        """Coordinator handler for the play counts edge processes report."""
+        for file_id, count in counts.items():
+            self.accesses[file_id] = self.accesses.get(file_id, 0) + count
+
+    def take_accesses(self):
+        counts, self.accesses = self.accesses, {}
+        return counts
+
+    def enqueue(self, file_id, priority, whole=False):
+        if (file_id, whole) in self.queued:
+            return
+        self.queued.add((file_id, whole))
+        self.sequence += 1
+        heapq.heappush(self.queue, (priority, self.sequence, file_id, whole))
+        self.wakeup.set()
+
+    async def pin(self, file_doc, pinned=True):
+        """
+        Marks a file to be kept fully cached, or stops doing so. Returns False,
+        leaving it unpinned, when the owner-pinned files would outgrow the chunk
+        store's pin budget.
+        """
+        file_key = f"{file_doc['channel_id']}_{file_doc['message_id']}"
+        if pinned:
+            total = file_doc.get("file_size") or 0
+            async for other in files_col.find({"pinned": True, "_id": {"$ne": file_doc["_id"]}}, {"file_size": 1}):
+                total += other.get("file_size") or 0
+            if total > cache.store.pin_limit:
+                return False
+        await files_col.update_one({"_id": file_doc["_id"]}, {"$set": {"pinned": pinned}})
+        invalidate_file_doc(file_doc["_id"])
+        if pinned:
+            self.enqueue(str(file_doc["_id"]), PINNED, whole=True)
+        else:
+            # Back to the seek index and opening seconds every indexed file keeps
+            meta = cache.store.get_meta(file_key)
+            if meta and meta.get("container"):
+                cache.store.pin(file_key, chunks_to_pin(meta["container"], meta["file_size"]))
+            else:
+                cache.store.unpin(file_key)
+        return True
+
+    async def queue_new_files(self):
+        if self.last_id is None:
+            # Start from the newest file; the existing catalog warms through plays
+            newest = await files_col.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+            self.last_id = newest["_id"] if newest else None
+            return
+        cursor = files_col.find({"_id": {"$gt": self.last_id}}, {"file_name": 1}).sort("_id", 1)
+        async for file_doc in cursor:
+            self.last_id = file_doc["_id"]
+            if not file_doc.get("file_name", "").lower().endswith(".srt"):
+                self.enqueue(str(file_doc["_id"]), NEW)
+
+    def queue_trending_files(self):
+        trending = sorted(self.accesses, key=self.accesses.get, reverse=True)[:WARM_TRENDING_FILES]
+        for file_id in trending:
+            self.enqueue(file_id, TRENDING)
+        self.accesses = {file_id: count // 2 for file_id, count in self.accesses.items() if count > 1}
+
+    async def queue_pinned_files(self):
+        # Chunks still cached are skipped, so this only refills what was evicted
+        async for file_doc in files_col.find({"pinned": True}, {"_id": 1}):
+            self.enqueue(str(file_doc["_id"]), PINNED, whole=True)
+
+    async def wait_for_idle_workers(self):
+        worker_manager = get_worker_manager()
+        while worker_manager.free_slots() <= WARM_RESERVED_SLOTS:
+            await asyncio.sleep(1)
+
+    async def warm(self, file_doc, whole, get_file_meta, fetch_chunks):
+        channel_id, message_id = file_doc["channel_id"], file_doc["message_id"]
+        file_key = f"{channel_id}_{message_id}"
+        await self.wait_for_idle_workers()
+        chunk_count = (await get_file_meta(file_doc))["chunk_count"]
+        if whole and chunk_count * CHUNK_SIZE > cache.store.pin_limit:
+            # Warming it all would evict the rest of the cache, and then itself
+            logger.warning(f"{file_key} is larger than the pin budget, warming its head and tail only")
+            whole = False
+        if whole:
+            if file_doc.get("pinned"):
+                # Pinned chunks survive eviction, so later passes only refill what is missing
+                cache.store.pin(file_key, range(chunk_count))
+            indices = range(chunk_count)
+        else:
+            indices = sorted(set(range(min(WARM_HEAD_CHUNKS, chunk_count)))
+                             | set(range(max(0, chunk_count - WARM_TAIL_CHUNKS), chunk_count)))
+        fetch_run = partial(fetch_chunks, channel_id, message_id)
+        for index in indices:
+            if (file_key, index) in cache:
+                continue
+            await self.wait_for_idle_workers()
+            # Chunks after this one that the run covers are awaited, not refetched, next time round
+            run_length = 1
+            while run_length < MAX_BATCH_CHUNKS and index + run_length in indices:
+                run_length += 1
+            if not await cache.get_or_fetch_run(file_key, index, run_length, fetch_run):
+                return
+
+    async def run(self, get_file_meta, fetch_chunks):
+        """Background task: queues files every WARM_INTERVAL and warms them one at a time."""
+        asyncio.create_task(self.schedule())
+        while True:
+            if not self.queue:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            _, _, file_id, whole = heapq.heappop(self.queue)
+            self.queued.discard((file_id, whole))
+            try:
+                file_doc = await get_file_doc(file_id)
+                if file_doc:
+                    await self.warm(file_doc, whole, get_file_meta, fetch_chunks)
+            except HTTPException as e:
+                logger.warning(f"Skipped warming {file_id}: {e.detail}")
+            except Exception as e:
+                logger.error(f"Warming {file_id} failed: {e}", exc_info=True)
+
+    async def schedule(self):
+        while True:
+            try:
+                self.queue_trending_files()
+                await self.queue_pinned_files()
+                await self.queue_new_files()
+            except Exception as e:
+                logger.error(f"Queueing files to warm failed: {e}")
+            await asyncio.sleep(WARM_INTERVAL)
+
+
+async def report_accesses():
+    """Edge processes forward their play counts to the coordinator, which warms."""
+    while True:
+        await asyncio.sleep(WARM_INTERVAL)
+        counts = warmer.take_accesses()
+        if counts:
+            try:
+                await coordinator.call("accesses", counts=counts)
+            except HTTPException:
+                pass
+
+
+warmer = CacheWarmer()